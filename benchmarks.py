@@ -0,0 +1,306 @@
+"""
+Benchmarks for observer.py.
+
+Each scenario builds a graph, then times single operations on it: usually
+one set on a source Variable and everything that propagates from it. Each
+scenario runs in its own process. Memory is how far the process's peak
+resident set size rose while building the graph and running the operations,
+so it includes transient allocations.
+
+Scenarios that need something this observer.py lacks are skipped, so the
+same file can measure older trees.
+
+    python benchmarks.py                        # run everything
+    python benchmarks.py chain fanout           # run some scenarios
+    python benchmarks.py --scale 10             # bigger graphs
+    python benchmarks.py --iterative            # with propagator.iterative set
+    python benchmarks.py --save base.json       # keep the results
+    python benchmarks.py --compare base.json    # report changes against them
+
+With --compare, the exit status is 1 if any scenario's median latency got
+worse by more than --threshold (default 10%).
+
+Propagation recurses, so chain and adders fail with RuntimeError once
+scaled past Python's recursion limit, unless run with --iterative.
+compiled_adders doesn't recurse.
+"""
+
+import collections
+import functools
+import gc
+import json
+import optparse
+import os
+import resource
+import subprocess
+import sys
+import timeit
+
+import observer
+from observer import *
+
+class Double(Algorithm):
+    _inputs_=('a',)
+    _outputs_=('c',)
+    _scheduled_=True
+    def update(self):
+        self.c.value=self.a.value*2
+
+class Increment(Double):
+    def update(self):
+        self.c.value=self.a.value+1
+
+class Total(Algorithm):
+    _inputs_=('a','b')
+    _outputs_=('c',)
+    _scheduled_=True
+    def update(self):
+        self.c.value=self.a.value+self.b.value
+
+class Adder(Algorithm):
+    _inputs_=('a','b')
+    _outputs_=('c',)
+    def update(self):
+        self.c.value=self.a.value+self.b.value
+
+def chain(size):
+    """
+    size Variables, each tracking the one before
+    """
+    head=tail=Variable(0)
+    graph=[head]
+    for i in range(size):
+        v=Variable(0)
+        v.track_variable(tail)
+        graph.append(v)
+        tail=v
+    return graph,head.set
+
+def fanout(size):
+    """
+    size Variables tracking one source
+    """
+    source=Variable(0)
+    graph=[source]
+    for i in range(size):
+        v=Variable(0)
+        v.track_variable(source)
+        graph.append(v)
+    return graph,source.set
+
+def diamond(size):
+    """
+    size diamonds in series: each doubles and increments its input and adds the two
+    """
+    source=tail=Variable(0)
+    graph=[source]
+    for i in range(size):
+        double,increment,total=Double(a=0),Increment(a=0),Total(a=0,b=0)
+        double.a.track_variable(tail)
+        increment.a.track_variable(tail)
+        total.a.track_variable(double.c)
+        total.b.track_variable(increment.c)
+        graph.extend((double,increment,total))
+        tail=total.c
+    return graph,source.set
+
+def adders(size):
+    """
+    adderExample scaled up: size cascaded Adders, each adding a fresh input
+    """
+    source=tail=Variable(0)
+    graph=[source]
+    for i in range(size):
+        adder=Adder(a=0,b=0)
+        adder.a.track_variable(tail)
+        adder.b.track_variable(Variable(1))
+        graph.append(adder)
+        tail=adder.c
+    return graph,source.set
+
+def compiled_adders(size):
+    """
+    The adders scenario, run through compile_graph
+    """
+    graph,setter=adders(size)
+    compiled=compile_graph(graph[:1])
+    return (graph,compiled),functools.partial(compiled.set,graph[0])
+
+def operator_tree(size):
+    """
+    A balanced tree of variable_operation Adds over size leaves. Sets one leaf
+    """
+    leaves=[Variable(0) for i in range(max(size,2))]
+    level=leaves
+    while len(level) > 1:
+        level=[variable_operation(Add,*level[i:i+2]) if i+1 < len(level) else level[i]
+               for i in range(0,len(level),2)]
+    return (leaves,level[0]),leaves[0].set
+
+def fused_expression(size):
+    """
+    The same sum built with operators, which fuse into one Expression
+    """
+    leaves=[Variable(0) for i in range(max(size,2))]
+    total=sum(leaves[1:],leaves[0])
+    total.observe(lambda value: None)  # keep it eager
+    return (leaves,total),leaves[0].set
+
+def batch(size):
+    """
+    size sets coalesced into one update of a 10-Adder cascade
+    """
+    graph,setter=adders(10)
+    source=graph[0]
+    def op(value):
+        with source.updates_coalesced():
+            for i in range(size):
+                source.value=value+i
+    return graph,op
+
+# What a scenario needs from observer.py. Without the propagator, diamond's
+# Totals would update once per input instead of once per set
+requires={
+    'diamond': 'propagator',
+    'compiled_adders': 'compile_graph',
+}
+
+def available(name):
+    return name not in requires or hasattr(observer,requires[name])
+
+scenarios=collections.OrderedDict([
+    ('chain',(chain,200)),
+    ('fanout',(fanout,1000)),
+    ('diamond',(diamond,100)),
+    ('adders',(adders,50)),
+    ('compiled_adders',(compiled_adders,50)),
+    ('operator_tree',(operator_tree,256)),
+    ('fused_expression',(fused_expression,64)),
+    ('batch',(batch,100)),
+])
+
+def percentile(ordered,fraction):
+    return ordered[min(len(ordered)-1,int(fraction*len(ordered)))]
+
+def peak_rss_kb():
+    """
+    Peak resident set size of this process so far
+    """
+    peak=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak//1024 if sys.platform == 'darwin' else peak  # bytes there, kB elsewhere
+
+def measure(name,size,ops,warmup):
+    """
+    Build scenario name at size and time ops operations. Returns a dict of results
+    """
+    build,default=scenarios[name]
+    clock=timeit.default_timer
+    gc.collect()
+    memory=peak_rss_kb()
+    start=clock()
+    graph,op=build(size)
+    built=clock()-start
+    for i in range(warmup):
+        op(i+1)
+    gc.collect()
+    gc.disable()
+    latencies=[]
+    try:
+        for i in range(ops):
+            start=clock()
+            op(i % 2)
+            latencies.append(clock()-start)
+    finally:
+        gc.enable()
+    memory=peak_rss_kb()-memory
+    latencies.sort()
+    return {
+        'size': size,
+        'ops': ops,
+        'build_seconds': built,
+        'ops_per_second': ops/sum(latencies),
+        'p50': percentile(latencies,0.5),
+        'p90': percentile(latencies,0.9),
+        'p99': percentile(latencies,0.99),
+        'max': latencies[-1],
+        'memory_kb': memory,
+    }
+
+def run(name,size,ops,warmup,iterative=False):
+    # Measure in a fresh interpreter, so memory covers one scenario
+    command=[sys.executable,os.path.abspath(__file__),'--child',name,
+             '--size',str(size),'--ops',str(ops),'--warmup',str(warmup)]
+    if iterative:
+        command.append('--iterative')
+    return json.loads(subprocess.check_output(command))
+
+def compare(results,baseline,threshold):
+    """
+    Print the change in median latency and memory against baseline.
+    Returns the names of scenarios that got slower by more than threshold
+    """
+    regressions=[]
+    for name,result in results.items():
+        base=baseline.get(name)
+        if base is None or base['size'] != result['size']:
+            print "%-18s no comparable baseline"%name
+            continue
+        change=result['p50']/base['p50']-1
+        flag=''
+        if change > threshold:
+            flag='  REGRESSION'
+            regressions.append(name)
+        memory=''
+        if 'memory_kb' in base:
+            memory='  memory %+d kB'%(result['memory_kb']-base['memory_kb'])
+        print "%-18s p50 %+6.1f%%%s%s"%(name,change*100,memory,flag)
+    return regressions
+
+def main(argv):
+    parser=optparse.OptionParser(usage="%prog [options] [scenario ...]",description=__doc__.split('\n\n')[0].strip())
+    parser.add_option('--scale',type='float',default=1.0,help="multiply every graph size")
+    parser.add_option('--ops',type='int',default=2000,help="timed operations per scenario")
+    parser.add_option('--warmup',type='int',default=100)
+    parser.add_option('--save',metavar='FILE',help="write the results as JSON")
+    parser.add_option('--compare',metavar='FILE',help="compare against results saved earlier")
+    parser.add_option('--threshold',type='float',default=0.1)
+    parser.add_option('--iterative',action='store_true',help="propagate iteratively")
+    parser.add_option('--child',help=optparse.SUPPRESS_HELP)
+    parser.add_option('--size',type='int',help=optparse.SUPPRESS_HELP)
+    options,names=parser.parse_args(argv)
+
+    if options.iterative:
+        if not hasattr(observer,'propagator'):
+            parser.error("--iterative needs a propagator")
+        propagator.iterative=True
+    if options.child:
+        print json.dumps(measure(options.child,options.size,options.ops,options.warmup))
+        return 0
+
+    for name in names:
+        if name not in scenarios:
+            parser.error("unknown scenario %r (choose from %s)"%(name,', '.join(scenarios)))
+    results=collections.OrderedDict()
+    print "%-18s %7s %12s %10s %10s %10s %10s"%('scenario','size','ops/s','p50 us','p90 us','p99 us','memory kB')
+    for name in names or scenarios:
+        if not available(name):
+            print "%-18s skipped: observer.py has no %s"%(name,requires[name])
+            continue
+        size=max(1,int(scenarios[name][1]*options.scale))
+        result=results[name]=run(name,size,options.ops,options.warmup,options.iterative)
+        print "%-18s %7d %12.0f %10.1f %10.1f %10.1f %10d"%(
+            name,size,result['ops_per_second'],result['p50']*1e6,result['p90']*1e6,result['p99']*1e6,result['memory_kb'])
+
+    if options.save:
+        with open(options.save,'w') as f:
+            json.dump(results,f,indent=1)
+    if options.compare:
+        with open(options.compare) as f:
+            baseline=json.load(f)
+        print
+        if compare(results,baseline,options.threshold):
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
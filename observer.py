@@ -127,34 +127,126 @@ use the `blocked` flag to suppress processing until the parent data has stopped
 flapping about. There is also an `enable` flag which is useful to stop your
 algorithm from executing until the inputs are connected.
 
-# ** Todo: ** I don't care about weak references for now. At some point I may add them, but 
-# ** Todo: ** Make block/unblock operations threadsafe
+Observers can be registered weakly with `observe(callback,weak=True)`. Derived
+Variables built with operators are wired this way, so dropping them frees the
+whole expression.
+
+Observers can also be filtered with `threshold=`, `key=` or `predicate=`, so
+that only the interested ones are called. Thresholds and keys are indexed,
+so thousands of alerts on one Variable cost little per change.
+
+To change a graph from several threads, pass every change through
+`propagator.submit()`. Changes are serialized into transactions.
+
+For graphs deeper than the recursion limit allows, set `propagator.iterative`.
+
+To push bulk data into a graph, pass records to `feed()`. It applies them in
+batches of a given size or time window, one transaction each, and yields
+the chosen outputs after every batch.
+
+To run part of a graph in another process, use a `Partition`. Variables
+crossing the boundary are mirrored through a pipe, one batch per wave, and
+their `blocked` flags are mirrored too. The worker's changes are applied on
+your thread, by `sync()` or `poll()`.
+
+To see where propagation time goes, run a `Profiler`. It reports per-Algorithm
+update counts and times, notification fan-out and wave depth, and can export
+collapsed stacks for flame graphs.
 """
 
 __all__=(
 
 'Observable', 'Variable', 'IdentityVariable', 'AlwaysUpdateVariable',
 
-'Algorithm', 'Add', 'Subtract', 'Multiply', 'Divide',
+'VersionedVariable',
+
+'ThrottledVariable', 'DebouncedVariable',
+
+'ListVariable', 'DictVariable', 'Delta',
+
+'Algorithm', 'Add', 'Subtract', 'Multiply', 'Divide', 'Expression',
+
+'Propagator', 'propagator', 'transaction', 'AsyncAlgorithm', 'Profiler',
+
+'compile_graph', 'CompiledGraph', 'Recorder', 'replay', 'feed', 'snapshot', 'restore',
+
+'ProxySender', 'ProxyReceiver', 'Partition',
 
 'linkVariables', 'unlinkVariables',
 
 'variable_operation',
 
+'VariableArray', 'ArrayAdd', 'ArraySubtract', 'ArrayMultiply', 'ArrayDivide',
+
 'any_var_is_none','debugVariable', 'pp',
 
 )
 
 
+import bisect
+import collections
 import functools
+import hashlib
+import heapq
+import itertools
+import json
+import mmap
+import multiprocessing
 import operator
+import os
+import struct
+import sys
+import threading
+import time
+import timeit
+import weakref
 
 from contextlib import contextmanager
 
+try:
+    import numpy
+except ImportError:
+    numpy=None
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
 #Set __DEBUG__ to true to track the nesting level. This is a bit slower. The pretty-printing function can use it 
 __DEBUG__ = False 
 _nest_level=0
 
+#Bumped whenever a link between graph nodes (an Algorithm input, a tracking Variable) is made
+#or removed. Cached Algorithm depths are only valid for one version
+_structure_version=0
+
+#Bumped by every observe() and unobserve()
+_wiring_version=0
+
+#Set while notifications have to do more than call the observers: hold the propagator
+#open because a scheduled Algorithm exists, run iteratively, or report to a Profiler
+_full_notify=False
+
+#Returned by weakly held observers whose target has been collected
+_DEAD=object()
+
+#Memo key for Algorithm inputs that can't be hashed
+_UNCACHEABLE=object()
+
+#Stands in for Algorithm port attributes that haven't been set
+_MISSING=object()
+
+#Nesting level of transaction() blocks, and the Variables set inside them, in order
+_transaction_depth=0
+_transaction_pending=[]
+
+#Variables blocked or unblocked inside a transaction: whether each should end up blocked on commit
+_transaction_blocking=collections.OrderedDict()
+
+#The running Profiler, if any
+_profiler=None
+
 def adderExample():
     """
     Simple example. Returns a tuple containing two cascaded adders and three input variables that feed them.
@@ -230,20 +322,178 @@ class Observable(object):
         >>> o.value=5
         >>> o.value
         5
+
+        Observers can be held weakly, so observing doesn't keep them alive.
+        Bound methods hold their object weakly, functions hold themselves weakly.
+        An observer is dropped as soon as its target is collected
+        >>> class Printer(object):
+        ...     def show(self,value):
+        ...         print "printer: %r"%(value,)
+        >>> printer=Printer()
+        >>> o.observe(printer.show,weak=True)
+        >>> o.value=6
+        printer: 6
+        >>> del printer
+        >>> o.observers
+        []
+        >>> o.value=7
+
+        observers is a list, and changing it changes the observers
+        >>> o.observers.append(p)
+        >>> o.value=8
+        value changed: 8
+        >>> o.observers.remove(p)
+        >>> o.value=9
     """
-    __slots__ = ('observers','_value')
+    # _observers is None, a single callback, or an _ObserverSet when there are several
+    # _wired: _wiring_version at the last change to the observers
+    __slots__ = ('_observers','_value','_wired','__weakref__')
     
     equality_test=operator.eq
 
     def __init__(self,initialValue=None):
-        self.observers=[]
+        self._observers=None
         self._value=initialValue
+        self._wired=0
         
-    def observe(self,callback):
-        self.observers.append(callback)
+    def observe(self,callback,weak=False,predicate=None,key=_MISSING,threshold=None):
+        """
+        Call callback(value) whenever the value changes.
+
+        With a filter, callback is only called for some values, and the
+        Observable indexes the filtered observers so the others aren't
+        called at all: with threshold, when the value crosses it (moves
+        between below and at-or-above); with key, when the value becomes
+        equal to key; with predicate, when predicate(value) is true.
+        Threshold observers are called in the order the value passes them,
+        then key observers, then predicate observers. A change from None
+        rises past every threshold at or below the new value, and a change to
+        None crosses none. Filtered observers can't be Variables or
+        Algorithms: link those unfiltered, so the propagator sees the link.
+
+            >>> t=Variable(20)
+            >>> t.observe(pp("above 30"),threshold=30)
+            >>> t.observe(pp("above 25"),threshold=25)
+            >>> t.observe(pp("frozen"),key=0)
+            >>> t.observe(pp("odd"),predicate=lambda value: value % 2)
+            >>> t.value=26
+            above 25: 26
+            >>> t.value=28
+            >>> t.value=31
+            above 30: 31
+            odd: 31
+            >>> t.value=0
+            above 30: 0
+            above 25: 0
+            frozen: 0
+            >>> len(t.observers)
+            1
+
+            >>> n=Variable()
+            >>> n.observe(pp("above 5"),threshold=5)
+            >>> n.observe(pp("above 20"),threshold=20)
+            >>> n.value=10
+            above 5: 10
+            >>> n.observe(Variable().set,threshold=5)
+            Traceback (most recent call last):
+                ...
+            TypeError: Filtered observers can't be Variables or Algorithms
+
+            unobserve() finds filtered observers next to plain ones
+            >>> alert=pp("alert")
+            >>> t.observe(pp("plain"))
+            >>> t.observe(alert,threshold=5)
+            >>> t.unobserve(alert)
+            >>> t.value=6
+            plain: 6
+        """
+        global _wiring_version
+        _wiring_version+=1
+        self._wired=_wiring_version
+        if weak:
+            callback=_WeakCallback(callback,self)
+        _note_link(callback)
+        if predicate is not None or key is not _MISSING or threshold is not None:
+            if isinstance(_callback_target(callback)[0],(Variable,Algorithm)):
+                raise TypeError("Filtered observers can't be Variables or Algorithms")
+            index=self._observer_index()
+            if index is None:
+                index=_ObserverIndex(self._value)
+                self.observe(index)
+            index.add(callback,predicate,key,threshold)
+            return
+        observers=self._observers
+        if observers is None:
+            self._observers=callback
+        elif type(observers) is _ObserverSet:
+            observers.add(callback)
+        else:
+            self._observers=_ObserverSet((observers,callback))
         
     def unobserve(self,callback):
-        self.observers.remove(callback)
+        if not self._discard_observer(callback):
+            raise ValueError("%r is not an observer"%(callback,))
+
+    def _discard_observer(self,callback):
+        # Remove callback, wherever it is registered. Returns whether it was an observer
+        global _wiring_version
+        _wiring_version+=1
+        self._wired=_wiring_version
+        _note_link(callback)
+        observers=self._observers
+        if type(observers) is _ObserverSet:
+            if observers.discard(callback):
+                if not observers:
+                    self._observers=None
+                return True
+        elif observers is not None and (observers is callback or observers == callback):
+            self._observers=None
+            return True
+        index=self._observer_index()
+        if index is None or not index.remove(callback):
+            return False
+        if not index:
+            self._discard_observer(index)
+        return True
+
+    def _observer_index(self):
+        # The _ObserverIndex holding the filtered observers, if there are any
+        observers=self._observers
+        if type(observers) is _ObserverIndex:
+            return observers
+        if type(observers) is _ObserverSet:
+            return observers.filtered
+        return None
+
+    @property
+    def observers(self):
+        """
+        A list of the current observers, in notification order.
+        Changing the list, or assigning a new one, replaces the observers
+        """
+        observers=self._observers
+        if observers is None:
+            return _ObserverList(self,())
+        elif type(observers) is _ObserverSet:
+            return _ObserverList(self,observers)
+        else:
+            return _ObserverList(self,(observers,))
+
+    @observers.setter
+    def observers(self,callbacks):
+        self._replace_observers(callbacks)
+
+    def _replace_observers(self,callbacks):
+        global _wiring_version
+        callbacks=list(callbacks)
+        _wiring_version+=1
+        self._wired=_wiring_version
+        self._observers=None
+        for o in callbacks:
+            Observable.observe(self,o)
+
+    def _prepend_observer(self,callback):
+        self._replace_observers([callback]+self.observers)
         
     def get(self):
         return self._value
@@ -260,26 +510,406 @@ class Observable(object):
             self.notify_observers()
 
     def notify_observers(self):
-        for o in self.observers:
-            o(self._value)
+        observers=self._observers
+        if observers is None:
+            return
+        if _full_notify:
+            self._notify_holding(observers)
+        elif type(observers) is _ObserverSet:
+            dead=False
+            for o in observers.entries:
+                if o is not None and o(self._value) is _DEAD:
+                    dead=True
+            if dead:
+                self._prune_observers()
+        elif observers(self._value) is _DEAD:
+            self._observers=None
+
+    def _notify_holding(self,observers):
+        # Notify while holding the propagator open, so that whatever is scheduled runs once, at the end
+        p=propagator
+        if p._iterative:
+            # [observable, value, callbacks, next callback (-1 before starting), any dead]
+            frame=[self,self._value,observers.entries if type(observers) is _ObserverSet else (observers,),-1,False]
+            if p._deferred is None:
+                p._run_notifications(frame)
+            else:
+                p._deferred.append(frame)
+            return
+        profiler=_profiler
+        if profiler is not None:
+            profiler._notifying(self,observers)
+        p._holds+=1
+        dead=False
+        try:
+            if type(observers) is _ObserverSet:
+                for o in observers.entries:
+                    if o is not None and o(self._value) is _DEAD:
+                        dead=True
+            elif observers(self._value) is _DEAD:
+                dead=True
+        finally:
+            p._holds-=1
+            if profiler is not None:
+                profiler._notified()
+        if dead:
+            self._prune_observers()
+        if not p._holds and p._queue:
+            p.drain()
+
+    def _prune_observers(self):
+        observers=self._observers
+        if type(observers) is _ObserverSet:
+            observers.compact()
+            if not observers:
+                self._observers=None
+        elif _is_dead(observers):
+            self._observers=None
 
             
     if __DEBUG__:
         _notify_observers=notify_observers
 
         def notify_observers(self):
-            if __DEBUG__:
-                globals()['_nest_level'] += 1
-
-            for o in self.observers:
-                o(self._value)
-
-            if __DEBUG__:
+            globals()['_nest_level'] += 1
+            try:
+                self._notify_observers()
+            finally:
                 globals()['_nest_level'] -= 1
                 
     value = property(get,set) 
 
 
+class _ObserverList(list):
+    # Observable.observers: a list that writes changes back to the Observable
+    __slots__=('_observable',)
+
+    def __init__(self,observable,callbacks):
+        list.__init__(self,callbacks)
+        self._observable=observable
+
+def _write_through(name):
+    method=getattr(list,name)
+    def mutate(self,*args,**kwargs):
+        result=method(self,*args,**kwargs)
+        self._observable._replace_observers(self)
+        return result
+    mutate.__name__=name
+    return mutate
+
+for _name in ('append','extend','insert','remove','pop','reverse','sort',
+              '__setitem__','__delitem__','__setslice__','__delslice__','__iadd__'):
+    setattr(_ObserverList,_name,_write_through(_name))
+del _name
+
+def _note_link(callback):
+    # Wiring an Algorithm input or a tracking Variable changes Algorithm depths
+    global _structure_version
+    if isinstance(_callback_target(callback)[0],(Variable,Algorithm)):
+        _structure_version+=1
+
+class _WeakCallback(object):
+    """
+    Observer entry that holds its callback weakly. Compares equal to the
+    callback it wraps, so unobserve() works as usual. When the callback is
+    collected, the entry removes itself from owner's observers, so dead
+    entries don't pile up on an Observable that never changes.
+
+        >>> class Printer(object):
+        ...     def show(self,value):
+        ...         print value
+        >>> o=Observable(0)
+        >>> printers=[Printer() for i in range(3)]
+        >>> for printer in printers:
+        ...     o.observe(printer.show,weak=True)
+        >>> del printers[:2]
+        >>> len(o.observers)
+        1
+    """
+    # _hash: the hash of the callback, which stays put once it has been collected
+    __slots__=('_ref','_func','_hash','_owner','__weakref__')
+
+    def __init__(self,callback,owner=None):
+        target=getattr(callback,'__self__',None)
+        if target is None:
+            target=callback
+            self._func=None
+        else:
+            self._func=callback.__func__
+        self._hash=hash(target) if self._func is None else hash(target)^hash(self._func)  # as a bound method
+        if owner is None:
+            self._ref=weakref.ref(target)
+            self._owner=None
+        else:
+            self._ref=weakref.ref(target,self._collected)
+            self._owner=weakref.ref(owner)
+
+    def _collected(self,ref):
+        owner=self._owner()
+        if owner is not None:
+            owner._discard_observer(self)
+
+    def __call__(self,value):
+        target=self._ref()
+        if target is None:
+            return _DEAD
+        if self._func is None:
+            target(value)
+        else:
+            self._func(target,value)
+
+    @property
+    def __self__(self):
+        """
+        The bound object (or function), or None once it has been collected
+        """
+        return self._ref()
+
+    def __eq__(self,other):
+        if isinstance(other,_WeakCallback):
+            return self._func is other._func and self._ref() is other._ref() is not None
+        target=self._ref()
+        if self._func is None:
+            return target is not None and target == other
+        return getattr(other,'__self__',None) is target and getattr(other,'__func__',None) is self._func
+
+    def __ne__(self,other):
+        return not self == other
+
+    def __hash__(self):
+        return self._hash
+
+
+def _is_dead(callback):
+    return isinstance(callback,_WeakCallback) and callback._ref() is None
+
+class _ObserverSet(object):
+    """
+    The observers of an Observable that has more than one, in registration order.
+
+    Adding and removing are O(1). Removal leaves a hole (None) in entries, and
+    entries is rebuilt once half of it is holes. Notification iterates entries
+    directly, so a rebuild during notification doesn't disturb it. Small sets
+    are searched. Larger ones are indexed by callback on the first removal,
+    so a set that is only added to costs a list slot per observer.
+
+        >>> def f(x): pass
+        >>> def g(x): pass
+        >>> s=_ObserverSet((f,g,f))
+        >>> s.remove(f)
+        >>> [o.__name__ for o in s], len(s)
+        (['g', 'f'], 2)
+        >>> s.remove(g)
+        >>> s.entries  # doctest: +ELLIPSIS
+        [<function f at 0x...>]
+        >>> s.remove(g)  # doctest: +ELLIPSIS
+        Traceback (most recent call last):
+            ...
+        ValueError: <function g at 0x...> is not an observer
+    """
+    # filtered: the _ObserverIndex among the entries, if there is one
+    # _index: None, or callback -> its position in entries, or a list of positions if added more than once
+    __slots__=('entries','_index','_holes','filtered')
+
+    def __init__(self,callbacks=()):
+        self.entries=[]
+        self._index=None
+        self._holes=0
+        self.filtered=None
+        for callback in callbacks:
+            self.add(callback)
+
+    def __len__(self):
+        return len(self.entries)-self._holes
+
+    def __iter__(self):
+        return (o for o in self.entries if o is not None)
+
+    def add(self,callback):
+        if self._index is not None:
+            self._note(callback,len(self.entries))
+        self.entries.append(callback)
+        if type(callback) is _ObserverIndex:
+            self.filtered=callback
+
+    def _note(self,callback,position):
+        index=self._index
+        known=index.get(callback)
+        if known is None:
+            index[callback]=position
+        elif type(known) is list:
+            known.append(position)
+        else:
+            index[callback]=[known,position]
+
+    def remove(self,callback):
+        if not self.discard(callback):
+            raise ValueError("%r is not an observer"%(callback,))
+
+    def discard(self,callback):
+        """
+        Remove callback if it is an observer. Returns whether it was
+        """
+        entries=self.entries
+        index=self._index
+        if index is None and len(entries) <= 8:
+            for i,o in enumerate(entries):
+                if o is not None and (o is callback or o == callback):
+                    break
+            else:
+                return False
+        else:
+            if index is None:
+                index=self._index={}
+                for i,o in enumerate(entries):
+                    if o is not None:
+                        self._note(o,i)
+            i=index.get(callback)
+            if i is None:
+                return False
+            if type(i) is list:
+                positions=i
+                i=positions.pop(0)
+                if len(positions) == 1:
+                    index[callback]=positions[0]
+            else:
+                del index[callback]
+        if entries[i] is self.filtered:
+            self.filtered=None
+        entries[i]=None
+        self._holes+=1
+        if self._holes*2 > len(entries):
+            self.compact()
+        return True
+
+    def compact(self):
+        """
+        Rebuild without holes or dead weak observers
+        """
+        live=[o for o in self.entries if o is not None and not _is_dead(o)]
+        self.entries=[]
+        self._index=None
+        self._holes=0
+        self.filtered=None
+        for callback in live:
+            self.add(callback)
+
+
+class _ObserverIndex(object):
+    """
+    The filtered observers of an Observable, registered with it as a single
+    observer. Thresholds are kept sorted, so a change only visits the ones
+    it crosses, and key observers are bucketed by key.
+
+        >>> s=_ObserverIndex(0)
+        >>> callbacks=dict((level,pp(level)) for level in (5,1,3))
+        >>> for level,callback in callbacks.items():
+        ...     s.add(callback,None,_MISSING,level)
+        >>> s(4)
+        1: 4
+        3: 4
+        >>> s(2)
+        3: 2
+        >>> s.remove(callbacks[3]), s._levels
+        (True, [1, 5])
+    """
+    # _registered: callback -> [(callback, [(bucket, level)])], one entry per add().
+    # Predicate registrations have bucket None and their _predicates entry as level
+    __slots__=('_last','_levels','_thresholds','_keys','_predicates','_registered','_count','__weakref__')
+
+    def __init__(self,value):
+        self._last=value
+        self._levels=[]
+        self._thresholds={}
+        self._keys={}
+        self._predicates=[]
+        self._registered={}
+        self._count=0
+
+    def __len__(self):
+        return self._count
+
+    def add(self,callback,predicate,key,threshold):
+        places=[]
+        if threshold is not None:
+            if threshold not in self._thresholds:
+                bisect.insort(self._levels,threshold)
+            self._thresholds.setdefault(threshold,[]).append(callback)
+            places.append((self._thresholds,threshold))
+        if key is not _MISSING:
+            self._keys.setdefault(key,[]).append(callback)
+            places.append((self._keys,key))
+        if predicate is not None:
+            entry=(predicate,callback)
+            self._predicates.append(entry)
+            places.append((None,entry))
+        self._registered.setdefault(callback,[]).append((callback,places))
+        self._count+=1
+
+    def remove(self,callback):
+        """
+        Remove the first registration of callback. Returns whether there was one
+        """
+        for registration in self._registered.get(callback,()):
+            if registration[0] is callback or registration[0] == callback:
+                self._drop(callback,registration)
+                return True
+        return False
+
+    def _drop(self,key,registration):
+        registrations=self._registered[key]
+        registrations.remove(registration)
+        if not registrations:
+            del self._registered[key]
+        self._count-=1
+        callback,places=registration
+        for bucket,level in places:
+            if bucket is None:
+                self._predicates.remove(level)
+                continue
+            callbacks=bucket[level]
+            callbacks.remove(callback)
+            if not callbacks:
+                del bucket[level]
+                if bucket is self._thresholds:
+                    del self._levels[bisect.bisect_left(self._levels,level)]
+
+    def _prune(self):
+        # Drop weak observers whose target has been collected
+        for key,registrations in list(self._registered.items()):
+            for registration in list(registrations):
+                if _is_dead(registration[0]):
+                    self._drop(key,registration)
+
+    def __call__(self,value):
+        called=[]
+        last,self._last=self._last,value
+        levels=self._levels
+        if levels and value is not None:
+            if last is None:
+                crossed=levels[:bisect.bisect_right(levels,value)]  # rising from below them all
+            else:
+                low,high=sorted((last,value))
+                crossed=levels[bisect.bisect_right(levels,low):bisect.bisect_right(levels,high)]
+                if value < last:
+                    crossed.reverse()
+            for level in crossed:
+                called.extend(self._thresholds[level])
+        if self._keys:
+            try:
+                called.extend(self._keys.get(value,()))
+            except TypeError:
+                pass
+        for predicate,callback in self._predicates:
+            if predicate(value):
+                called.append(callback)
+        dead=False
+        for callback in called:
+            if callback(value) is _DEAD:
+                dead=True
+        if dead:
+            self._prune()
+
 class Variable(Observable):
     """
     This variable also encapsulates second variable to be used as a "blocked" flag. 
@@ -333,23 +963,60 @@ class Variable(Observable):
         VALUE: 155
         BLOCKED: False
 
+        The blocked flag is only allocated once it is used. Until then the
+        Variable is simply unblocked
+        >>> w=Variable(1)
+        >>> w._blocked is None, w.is_blocked()
+        (True, False)
+        >>> w.blocked.value
+        False
+        >>> w._blocked is None
+        False
+
     """
-    __slots__=('blocked','pendingValue')
+    # _blocked is None until the blocked flag is first needed, or _HELD inside a transaction
+    __slots__=('_blocked','pendingValue','_producer')
     
     def __init__(self,initialValue=None):
         self.pendingValue=None
-        self.blocked=Observable(False)
+        self._producer=None   # Algorithm that writes this Variable. Refreshed before reads if lazy
+        self._blocked=None
         Observable.__init__(self,initialValue)
+
+    @property
+    def blocked(self):
+        """
+        The observable blocked flag, allocated on first access
+        """
+        blocked=self._blocked
+        if blocked is None or blocked is _HELD:
+            blocked=self._blocked=Observable(blocked is _HELD)
+        return blocked
+
+    def is_blocked(self):
+        blocked=self._blocked
+        return blocked is not None and blocked._value
         
     def block(self):
-        if self.blocked.value == False:
+        if _transaction_depth:
+            self._defer_blocking(True)
+        elif not self.is_blocked():
             self.pendingValue=self.value
             self.blocked.set(True)
         
     def unblock(self):
-        if self.blocked.value == True:
+        if _transaction_depth:
+            self._defer_blocking(False)
+        elif self.is_blocked():
             self._set(self.pendingValue)
-            self.blocked.set(False)
+            propagator._after(self.blocked.set,False)  # observers of the value still see it blocked
+
+    def _defer_blocking(self,blocked):
+        # Inside a transaction, block() and unblock() take effect on commit.
+        # Until then the Variable is held, so that nothing set under the block escapes
+        if self not in _transaction_blocking and not self.is_blocked():
+            self._enlist(self._value)
+        _transaction_blocking[self]=blocked
         
     def setBlocked(self,blocked):
         if blocked:
@@ -368,37 +1035,89 @@ class Variable(Observable):
         
     def set(self,value):
         """
-        set value, or cache it if currently blocked
+        set value, or cache it if currently blocked or inside a transaction
         """
-        if self.blocked.value:
+        blocked=self._blocked
+        if blocked is not None and blocked._value:
             self.pendingValue=value
+        elif _transaction_depth:
+            self._enlist(value)
         else:
              self._set(value)
+
+    def _enlist(self,value):
+        # Block without notifying anyone. The transaction unblocks on commit
+        self.pendingValue=value
+        if self._blocked is None:
+            self._blocked=_HELD
+        else:
+            self._blocked._value=True
+        _transaction_pending.append(self)
+
+    def _assign(self,value):
+        # Store value without notifying anyone. Returns True if it changed
+        if self.equality_test(self._value,value):
+            return False
+        self._value=value
+        return True
+
+    def _discard(self):
+        # Drop the pending value
+        self.pendingValue=self._value
+
+    def _release(self):
+        # Silently undo _enlist. Returns False if the Variable was unblocked in the meantime
+        blocked=self._blocked
+        if blocked is _HELD:
+            self._blocked=None
+        elif blocked is not None and blocked._value:
+            blocked._value=False
+        else:
+            return False
+        return True
                 
     def get(self):
-        if self.blocked.value:
+        producer=self._producer
+        if producer is not None and producer.updatePending:
+            producer.refresh()
+        blocked=self._blocked
+        if blocked is not None and blocked._value:
             return self.pendingValue
         else:
-            return super(Variable,self).get()  
+            return self._value
+
+    def observe(self,callback,weak=False,predicate=None,key=_MISSING,threshold=None):
+        producer=self._producer
+        if producer is not None and producer.updatePending:
+            producer.refresh()
+        super(Variable,self).observe(callback,weak,predicate,key,threshold)
 
-    def track_variable(self,sourceVar):
-        sourceVar.blocked.observe(self.setBlocked)
-        sourceVar.observe(self.set)
+    def track_variable(self,sourceVar,weak=False):
+        """
+        Follow sourceVar's value and blocked flag.
+        With weak=True, sourceVar doesn't keep this Variable alive
+        """
+        if isinstance(sourceVar,_CollectionVariable):
+            # It would see the same object every time, and never be notified again
+            raise TypeError("Track a collection with a ListVariable or DictVariable, or observe its deltas")
+        sourceVar.blocked.observe(self.setBlocked,weak)
+        sourceVar.observe(self.set,weak)
         self.set(sourceVar.value)
         
     def stop_tracking_variable(self,sourceVar):
         sourceVar.blocked.unobserve(self.setBlocked)
         sourceVar.unobserve(self.set)
-        self.blocked.value=False
+        if self.is_blocked():
+            self.blocked.value=False
                            
     def __add__(self,x):
-        return variable_operation(Add,self,x)
+        return _fuse('+',self,x)
     def __sub__(self,x):
-        return variable_operation(Subtract,self,x)
+        return _fuse('-',self,x)
     def __mul__(self,x):
-        return variable_operation(Multiply,self,x)
+        return _fuse('*',self,x)
     def __div__(self,x):
-        return variable_operation(Divide,self,x)
+        return _fuse('/',self,x)
 
     value = property(get,set) 
         
@@ -431,133 +1150,794 @@ class AlwaysUpdateVariable(Variable):
     v1 value: 3
     """
     equality_test=lambda self,a,b: False
-def linkVariables(v1,v2):
-    """
-    Create a bidirectional link between v1 and v2.
-    The synchronized value depends on the blocked state:
-        If v1 isn't blocked, its value is propagated to v2
-        If v2 isn't blocked, its value is propageted to v1
-        If they're both blocked, nothing happens until on variable is unblocked
 
-    The variables are blocked as a group.
+class VersionedVariable(Variable):
+    """
+    A Variable for large values that are expensive to compare. Values are
+    treated as immutable and compared by identity, and every change bumps
+    `version`. Algorithms whose inputs all carry a version skip update() when
+    none of them changed since the last run, so a wave that reaches them
+    without a real change costs a tuple comparison.
 
-    Note that it's not safe to link variables where equality_test always returns False. 
-    Note that linking variables creates a cycle. if you don't unlink them later, you will leak memory
+    Set equality_test in a subclass to compare values after all.
 
-        Define a pretty printer for this example 
-        >>> def p(name):
-        ...     def q(value):
-        ...         print "%s: %r"%(name,value)
-        ...     return q
+        >>> class Count(Algorithm):
+        ...     _inputs_=(('text',VersionedVariable),)
+        ...     _outputs_=('n',)
+        ...     def update(self):
+        ...         print "counting"
+        ...         self.n.value=len(self.text.value)
+        >>> words=Count(text="a b")
+        counting
+        >>> words.text.version
+        0
+        >>> words.text.value="a b c"
+        counting
+        >>> words.text.version, words.n.value
+        (1, 5)
 
+        Waves that don't change the text don't run update()
+        >>> with words.text.updates_coalesced():
+        ...     pass
+        >>> words.enabled.value=False
+        >>> words.enabled.value=True
+        >>> words.text.value=words.text.value
+        >>> words.text.version
+        1
+    """
+    __slots__=('version',)
 
-        >>> v1=Variable(3)
-        >>> v2=Variable(4)
-        >>> v1.observe(p("V1"))
-        >>> v2.observe(p("V2"))
-        >>> v1.blocked.observe(p("V1 BLOCKED"))
-        >>> v2.blocked.observe(p("V2 BLOCKED"))
-        >>> linkVariables(v1,v2)
-        V2: 3
-        >>> print "v1: %r v2: %r"%(v1.value,v2.value)
-        v1: 3 v2: 3
-        >>> v1.value=6
-        V1: 6
-        V2: 6
+    equality_test=operator.is_
 
-        When unblocking linked variables, the eventual value will come from the
-        one that is unblocked first.
+    def __init__(self,initialValue=None):
+        Variable.__init__(self,initialValue)
+        self.version=0
 
-        Keep V2's value: 
-        >>> v2.block()
-        V2 BLOCKED: True
-        V1 BLOCKED: True
-        >>> v2.value=19
-        >>> v2.value=20
-        >>> v1.value=18
-        >>> v2.value=21
-        >>> v2.unblock()
-        V2: 21
-        V2 BLOCKED: False
-        V1: 21
-        V1 BLOCKED: False
+    def _set(self,value):
+        if not self.equality_test(self._value,value):
+            self._value=value
+            self.version+=1
+            self.notify_observers()
 
-        Keep V1's value:
-        >>> with v1.updates_coalesced():  #Variables diverge while blocked. v1's value is kept
-        ...     v2.value=22
-        ...     v1.value=23
-        ...     v2.value=24
-        V1 BLOCKED: True
-        V2 BLOCKED: True
-        V1: 23
-        V1 BLOCKED: False
-        V2: 23
-        V2 BLOCKED: False
+    def _assign(self,value):
+        if Variable._assign(self,value):
+            self.version+=1
+            return True
+        return False
 
-        >>> 
-        >>> unlinkVariables(v1,v2) #Break the cycle for GC
-        >>> v1.value=7
-        V1: 7
+#Shared stand-in for the blocked flag of Variables held by a transaction. Never observed or changed
+_HELD=Observable(True)
 
+class ThrottledVariable(Variable):
     """
-    v2.track_variable(v1)
-    v1.track_variable(v2)
-    
-def unlinkVariables(v1,v2):
-    v1.stop_tracking_variable(v2)
-    v2.stop_tracking_variable(v1)
+    Propagates at most one change per `interval` seconds. A change that comes
+    too soon is held in pendingValue, like a blocked Variable (but without
+    touching the blocked flag), and the latest held value goes out when it is
+    due. Reads see the latest value.
 
+    Time comes from `clock`. Held values are released by poll(), so either
+    call it regularly (e.g. from your event loop), or pass a `scheduler`:
+    scheduler(delay,callback) must call callback after delay seconds. If the
+    callback would run on another thread, wrap it in propagator.submit.
 
-def _get_variable_constructors(attributes,defaultType=Variable):
-    """
-    Used internally by Algorithm constructor to handle the _inputs_ and _outputs_ lists
+    To rate-limit a feed, make one of these track it.
 
-    attributes: each attribute can be a string, which becomes a variable name, 
-                or tuple (name,constructor)
-    returns: a list of pairs (attributeName, Constructor)
+        >>> now=[0.0]
+        >>> v=ThrottledVariable(0,interval=1.0,clock=lambda: now[0])
+        >>> v.observe(pp("v"))
+        >>> v.value=1
+        v: 1
+        >>> now[0]=0.25
+        >>> v.value=2
+        >>> v.value=3
+        >>> v.value
+        3
+        >>> v.poll()
+        >>> now[0]=1.0
+        >>> v.poll()
+        v: 3
+
+        >>> now[0]=2.5
+        >>> v.value=4
+        v: 4
+
+        Setting the same value again doesn't restart the interval
+        >>> now[0]=3.5
+        >>> v.value=4
+        >>> now[0]=4.0
+        >>> v.value=5
+        v: 5
+
+        Changes committed by a transaction, e.g. through submit(), are throttled too
+        >>> now[0]=10.0
+        >>> for i in (8,9,10):
+        ...     _=propagator.submit(v.set,i)
+        v: 8
+        >>> v.value
+        10
+        >>> with transaction():
+        ...     now[0]=11.0
+        ...     v.poll()
+        v: 10
+
+        With a scheduler, held values go out on their own
+        >>> timers=[]
+        >>> w=ThrottledVariable(0,interval=1.0,clock=lambda: now[0],scheduler=lambda delay,callback: timers.append((delay,callback)))
+        >>> w.observe(pp("w"))
+        >>> w.value=1
+        w: 1
+        >>> w.value=2
+        >>> w.value=3
+        >>> [delay for delay,callback in timers]
+        [1.0]
+        >>> now[0]=12.5
+        >>> timers.pop()[1]()
+        w: 3
     """
-    def get_constructor(attr):
-        if type(attr) == tuple:
-            return(attr)
+    __slots__=('interval','clock','scheduler','_due','_last','_timer_set')
+
+    def __init__(self,initialValue=None,interval=0,clock=time.time,scheduler=None):
+        Variable.__init__(self,initialValue)
+        self.interval=interval
+        self.clock=clock
+        self.scheduler=scheduler
+        self._due=None       # when the held value goes out, or None if nothing is held
+        self._last=None      # when the last change went out
+        self._timer_set=False
+
+    def _next_due(self,now):
+        return now if self._last is None else self._last+self.interval
+
+    def set(self,value):
+        if self.is_blocked() or _transaction_depth:
+            Variable.set(self,value)
+            return
+        now=self.clock()
+        due=self._next_due(now)
+        if due <= now:
+            self._set(value)
         else:
-            return(attr,defaultType)
-        
-    return map(get_constructor,attributes)
-               
-class Algorithm(object):
-    """
-    A container for input and output variables.  
-    To use, you must inherit from `Algorithm`   
+            self.pendingValue=value
+            self._due=due
+            self._arm(now)
 
-    Create class attributes `_inputs_` and `_outputs`, and the Algorithm default constructor will populate them with Variable() instances. 
-    Or initialize the variables yourself before calling the inherited constructor and it will leave them alone. 
-    
-    In either case, it will bind  inputs to call the update() function on change
-    It will also bind the valid flags to update into a central _valid_ object on the instance. 
+    def get(self):
+        if self._due is not None:
+            return self.pendingValue
+        return Variable.get(self)
 
-    There is a central enable() flag that is set to true by default.
-    If you need to bind values into the inputs before running the algorithm,
-    then set it to true in the constructor or by setting the class variable
-    `_start_enabled_`
+    def _set(self,value):
+        self._due=None
+        if self.equality_test(self._value,value):
+            return  # nothing goes out, so the window doesn't restart
+        self._last=self.clock()
+        Variable._set(self,value)
 
-        Define a pretty printer for this example 
-        >>> def p(name):
-        ...     def q(value):
-        ...         print "%s: %r"%(name,value)
-        ...     return q
+    def _assign(self,value):
+        # Committing a transaction: the change is held like one set outside it
+        if self.equality_test(self._value,value):
+            self._due=None
+            return False
+        now=self.clock()
+        due=self._next_due(now)
+        if due > now:
+            self.pendingValue=value
+            self._due=due
+            self._arm(now)
+            return False
+        self._due=None
+        self._last=now
+        self._value=value
+        return True
 
-        Your code goes in a subclass of Algorithm
-        >>> class  Adder(Algorithm):
-        ...     _inputs_=('a','b')
-        ...     _outputs_=('c',)
-        ...     _start_enabled_=False
-        ...
-        ...     def update(self):
-        ...         self.c.value = self.a.value + self.b.value
+    def poll(self):
+        """
+        Release the held value if it is due. Inside a transaction, it goes out
+        on commit
+        """
+        self._timer_set=False
+        if self._due is None or self.is_blocked():
+            return
+        now=self.clock()
+        if now < self._due:
+            self._arm(now)
+        elif _transaction_depth:
+            Variable.set(self,self.pendingValue)  # the commit checks it is still due
+        else:
+            self._set(self.pendingValue)
 
-        Input and output variables are automatically created
-        >>> adder=Adder()
-        >>> adder.a.observe(p("a"))
+    def flush(self):
+        """
+        Release the held value now
+        """
+        if self._due is not None and not self.is_blocked():
+            self._set(self.pendingValue)
+
+    def _arm(self,now):
+        if self.scheduler is not None and not self._timer_set:
+            self._timer_set=True
+            self.scheduler(self._due-now,self.poll)
+
+    value = property(get,set)
+
+class DebouncedVariable(ThrottledVariable):
+    """
+    Propagates a change once it has been left alone for `interval` seconds.
+    Otherwise like ThrottledVariable.
+
+        >>> now=[0.0]
+        >>> v=DebouncedVariable(0,interval=1.0,clock=lambda: now[0])
+        >>> v.observe(pp("v"))
+        >>> for t in (0.0,0.5,1.2):
+        ...     now[0]=t
+        ...     v.value=t
+        ...     v.poll()
+        >>> now[0]=2.1
+        >>> v.poll()
+        >>> now[0]=2.2
+        >>> v.poll()
+        v: 1.2
+    """
+    __slots__=()
+
+    def _next_due(self,now):
+        return now+self.interval
+
+class Delta(collections.namedtuple('Delta','kind key old new')):
+    """
+    One change to a ListVariable or DictVariable.
+    kind is 'insert', 'remove', 'replace' or 'reset'. key is the list index or
+    dict key. old and new are the values removed and added. A 'reset' replaces
+    the whole collection: new is a copy of the new contents, and old is the
+    previous collection.
+    """
+    __slots__=()
+
+class _CollectionVariable(Variable):
+    """
+    Base for Variables holding a mutable collection that changes in place.
+
+    Mutations apply immediately and record Deltas. Observers of `deltas` get
+    the list of Deltas since the last notification, then value observers get
+    the collection itself. While blocked or inside a transaction the Deltas
+    accumulate and are delivered together on unblock or commit. Nothing is
+    compared, so a mutation costs O(1) plus whatever it costs the list or dict.
+
+    Setting the value replaces the whole collection and records a 'reset'.
+    A collection tracking another one keeps its own copy, and replays the
+    source's Deltas on it. A plain Variable can't track a collection, since it
+    would see the same object every time: observe deltas instead.
+    """
+    __slots__=('deltas','_pending_deltas','_operands')
+
+    def __init__(self,initialValue=None):
+        Variable.__init__(self,self._empty() if initialValue is None else initialValue)
+        self.deltas=Observable([])
+        self._pending_deltas=[]
+
+    def observe_deltas(self,callback,weak=False):
+        self.deltas.observe(callback,weak)
+
+    def get(self):
+        producer=self._producer
+        if producer is not None and producer.updatePending:
+            producer.refresh()
+        return self._value
+
+    def set(self,value):
+        old,self._value=self._value,value
+        self._record(Delta('reset',None,old,self._copy(value)))
+
+    def _record(self,delta):
+        self._pending_deltas.append(delta)
+        if self.is_blocked():
+            return
+        if _transaction_depth:
+            self._enlist(self._value)
+        else:
+            self.notify_observers()
+
+    def _set(self,value):
+        # Unblocking: the value is already in place, just deliver the deltas
+        if self._pending_deltas:
+            self.notify_observers()
+
+    def _assign(self,value):
+        return bool(self._pending_deltas)
+
+    def _discard(self):
+        # Roll back in-place changes
+        for delta in reversed(self._pending_deltas):
+            self._undo(delta)
+        self._pending_deltas=[]
+        self.pendingValue=self._value
+
+    def notify_observers(self):
+        deltas,self._pending_deltas=self._pending_deltas,[]
+        if deltas:
+            self.deltas._value=deltas
+            self.deltas.notify_observers()
+        Variable.notify_observers(self)
+
+    def track_variable(self,sourceVar,weak=False):
+        if not isinstance(sourceVar,_CollectionVariable):
+            return Variable.track_variable(self,sourceVar,weak)
+        sourceVar.blocked.observe(self.setBlocked,weak)
+        sourceVar.observe_deltas(self._replay,weak)
+        self.set(self._copy(sourceVar.value))
+
+    def stop_tracking_variable(self,sourceVar):
+        if not isinstance(sourceVar,_CollectionVariable):
+            return Variable.stop_tracking_variable(self,sourceVar)
+        sourceVar.blocked.unobserve(self.setBlocked)
+        sourceVar.deltas.unobserve(self._replay)
+        if self.is_blocked():
+            self.blocked.value=False
+
+    def _replay(self,deltas):
+        for delta in deltas:
+            self._redo(delta)
+
+    def _follow_blocked(self,source):
+        source.blocked.observe(self.setBlocked)
+        self.setBlocked(source.is_blocked())
+
+    value = property(get,set)
+
+class ListVariable(_CollectionVariable):
+    """
+    A list that reports changes as Deltas keyed by index.
+
+        >>> l=ListVariable([1,2,3])
+        >>> l.observe_deltas(pp("deltas"))
+        >>> l.append(4)
+        deltas: [Delta(kind='insert', key=3, old=None, new=4)]
+        >>> l[0]=10
+        deltas: [Delta(kind='replace', key=0, old=1, new=10)]
+        >>> with l.updates_coalesced():
+        ...     del l[1]
+        ...     l.insert(0,0)
+        deltas: [Delta(kind='remove', key=1, old=2, new=None), Delta(kind='insert', key=0, old=None, new=0)]
+        >>> l.value
+        [0, 10, 3, 4]
+
+        Derived lists are maintained from the deltas
+        >>> squares=l.map(lambda x: x*x)
+        >>> squares.value
+        [0, 100, 9, 16]
+        >>> l.pop()
+        deltas: [Delta(kind='remove', key=3, old=4, new=None)]
+        4
+        >>> squares.value
+        [0, 100, 9]
+
+        Slices are changed an index at a time
+        >>> l[0:2]=[5]
+        deltas: [Delta(kind='replace', key=0, old=0, new=5)]
+        deltas: [Delta(kind='remove', key=1, old=10, new=None)]
+        >>> del l[:]
+        deltas: [Delta(kind='remove', key=1, old=3, new=None)]
+        deltas: [Delta(kind='remove', key=0, old=5, new=None)]
+        >>> l.extend([0,10,3])
+        deltas: [Delta(kind='insert', key=0, old=None, new=0)]
+        deltas: [Delta(kind='insert', key=1, old=None, new=10)]
+        deltas: [Delta(kind='insert', key=2, old=None, new=3)]
+        >>> squares.value
+        [0, 100, 9]
+
+        Transactions roll back in-place changes
+        >>> with transaction():
+        ...     l.append(5)
+        ...     raise ValueError
+        Traceback (most recent call last):
+            ...
+        ValueError
+        >>> l.value, squares.value
+        ([0, 10, 3], [0, 100, 9])
+
+        A tracking list replays the deltas on its own copy
+        >>> copy=ListVariable()
+        >>> copy.track_variable(l)
+        >>> copy.observe_deltas(pp("copy"))
+        >>> l[1]=11
+        deltas: [Delta(kind='replace', key=1, old=10, new=11)]
+        copy: [Delta(kind='replace', key=1, old=10, new=11)]
+        >>> copy.value, copy.value is l.value
+        ([0, 11, 3], False)
+        >>> copy.stop_tracking_variable(l)
+
+        A plain Variable would never hear about in-place changes
+        >>> Variable().track_variable(l)
+        Traceback (most recent call last):
+            ...
+        TypeError: Track a collection with a ListVariable or DictVariable, or observe its deltas
+    """
+    __slots__=()
+
+    _empty=staticmethod(list)
+    _copy=staticmethod(list)
+
+    def __len__(self):
+        return len(self._value)
+
+    def __getitem__(self,index):
+        return self._value[index]
+
+    def __setitem__(self,index,item):
+        if isinstance(index,slice):
+            self._set_slice(index,list(item))
+            return
+        index=self._index(index)
+        old=self._value[index]
+        self._value[index]=item
+        self._record(Delta('replace',index,old,item))
+
+    def _set_slice(self,index,items):
+        # Replace what overlaps, then remove or insert the rest, one Delta per index
+        start,stop,step=index.indices(len(self._value))
+        if step != 1:
+            positions=range(start,stop,step)
+            if len(items) != len(positions):
+                raise ValueError("attempt to assign sequence of size %d to extended slice of size %d"%(
+                    len(items),len(positions)))
+            for position,item in zip(positions,items):
+                self[position]=item
+            return
+        size=max(0,stop-start)
+        common=min(size,len(items))
+        for n in range(common):
+            self[start+n]=items[n]
+        for n in range(size-common):
+            self.pop(start+common)
+        for n in range(common,len(items)):
+            self.insert(start+n,items[n])
+
+    def __delitem__(self,index):
+        if isinstance(index,slice):
+            for position in sorted(range(*index.indices(len(self._value))),reverse=True):
+                self.pop(position)
+            return
+        self.pop(index)
+
+    def insert(self,index,item):
+        index=max(0,min(self._index(index) if index < 0 else index,len(self._value)))
+        self._value.insert(index,item)
+        self._record(Delta('insert',index,None,item))
+
+    def append(self,item):
+        self.insert(len(self._value),item)
+
+    def extend(self,items):
+        for item in items:
+            self.append(item)
+
+    def pop(self,index=-1):
+        index=self._index(index)
+        item=self._value.pop(index)
+        self._record(Delta('remove',index,item,None))
+        return item
+
+    def remove(self,item):
+        self.pop(self._value.index(item))
+
+    def _index(self,index):
+        return index+len(self._value) if index < 0 else index
+
+    def _undo(self,delta):
+        if delta.kind == 'insert':
+            del self._value[delta.key]
+        elif delta.kind == 'remove':
+            self._value.insert(delta.key,delta.old)
+        elif delta.kind == 'replace':
+            self._value[delta.key]=delta.old
+        else:
+            self._value=delta.old
+
+    def _redo(self,delta):
+        if delta.kind == 'insert':
+            self.insert(delta.key,delta.new)
+        elif delta.kind == 'remove':
+            self.pop(delta.key)
+        elif delta.kind == 'replace':
+            self[delta.key]=delta.new
+        else:
+            self.value=list(delta.new)
+
+    def map(self,func):
+        """
+        A ListVariable holding func(item) for each item, kept up to date from the deltas
+        """
+        derived=ListVariable([func(item) for item in self._value])
+        derived._follow_blocked(self)
+        def apply(deltas):
+            for delta in deltas:
+                if delta.kind == 'insert':
+                    derived.insert(delta.key,func(delta.new))
+                elif delta.kind == 'remove':
+                    derived.pop(delta.key)
+                elif delta.kind == 'replace':
+                    derived[delta.key]=func(delta.new)
+                else:
+                    derived.value=[func(item) for item in delta.new]
+        derived._operands=(self,apply)
+        self.observe_deltas(apply)
+        return derived
+
+class DictVariable(_CollectionVariable):
+    """
+    A dict that reports changes as Deltas keyed by dict key.
+
+        >>> book=DictVariable({'a':1})
+        >>> book.observe_deltas(pp("deltas"))
+        >>> book['b']=2
+        deltas: [Delta(kind='insert', key='b', old=None, new=2)]
+        >>> book['a']=3
+        deltas: [Delta(kind='replace', key='a', old=1, new=3)]
+        >>> del book['b']
+        deltas: [Delta(kind='remove', key='b', old=2, new=None)]
+
+        Derived dicts are maintained from the deltas
+        >>> big=book.select(lambda v: v > 2)
+        >>> big.observe_deltas(pp("big"))
+        >>> book.update({'c':5,'d':0})
+        deltas: [Delta(kind='insert', key='c', old=None, new=5), Delta(kind='insert', key='d', old=None, new=0)]
+        big: [Delta(kind='insert', key='c', old=None, new=5)]
+        >>> book['a']=0
+        deltas: [Delta(kind='replace', key='a', old=3, new=0)]
+        big: [Delta(kind='remove', key='a', old=3, new=None)]
+        >>> sorted(big.value.items())
+        [('c', 5)]
+    """
+    __slots__=()
+
+    _empty=staticmethod(dict)
+    _copy=staticmethod(dict)
+
+    def __len__(self):
+        return len(self._value)
+
+    def __contains__(self,key):
+        return key in self._value
+
+    def __getitem__(self,key):
+        return self._value[key]
+
+    def __setitem__(self,key,item):
+        if key in self._value:
+            old=self._value[key]
+            self._value[key]=item
+            self._record(Delta('replace',key,old,item))
+        else:
+            self._value[key]=item
+            self._record(Delta('insert',key,None,item))
+
+    def __delitem__(self,key):
+        self.pop(key)
+
+    def pop(self,key):
+        item=self._value.pop(key)
+        self._record(Delta('remove',key,item,None))
+        return item
+
+    def update(self,items):
+        """
+        Apply several changes, delivering their deltas together
+        """
+        if self.is_blocked() or _transaction_depth:
+            for key,item in dict(items).items():
+                self[key]=item
+        else:
+            with self.updates_coalesced():
+                for key,item in dict(items).items():
+                    self[key]=item
+
+    def _undo(self,delta):
+        if delta.kind == 'insert':
+            del self._value[delta.key]
+        elif delta.kind in ('remove','replace'):
+            self._value[delta.key]=delta.old
+        else:
+            self._value=delta.old
+
+    def _redo(self,delta):
+        if delta.kind == 'remove':
+            del self[delta.key]
+        elif delta.kind == 'reset':
+            self.value=dict(delta.new)
+        else:
+            self[delta.key]=delta.new
+
+    def select(self,predicate):
+        """
+        A DictVariable holding the items whose value satisfies predicate, kept up to date from the deltas
+        """
+        derived=DictVariable(dict((k,v) for k,v in self._value.items() if predicate(v)))
+        derived._follow_blocked(self)
+        def apply(deltas):
+            for delta in deltas:
+                if delta.kind == 'reset':
+                    derived.value=dict((k,v) for k,v in delta.new.items() if predicate(v))
+                elif delta.kind != 'remove' and predicate(delta.new):
+                    derived[delta.key]=delta.new
+                elif delta.key in derived:
+                    del derived[delta.key]
+        derived._operands=(self,apply)
+        self.observe_deltas(apply)
+        return derived
+
+def linkVariables(v1,v2):
+    """
+    Create a bidirectional link between v1 and v2.
+    The synchronized value depends on the blocked state:
+        If v1 isn't blocked, its value is propagated to v2
+        If v2 isn't blocked, its value is propageted to v1
+        If they're both blocked, nothing happens until on variable is unblocked
+
+    The variables are blocked as a group.
+
+    Note that it's not safe to link variables where equality_test always returns False. 
+    Note that linking variables creates a cycle. if you don't unlink them later, you will leak memory
+
+        Define a pretty printer for this example 
+        >>> def p(name):
+        ...     def q(value):
+        ...         print "%s: %r"%(name,value)
+        ...     return q
+
+
+        >>> v1=Variable(3)
+        >>> v2=Variable(4)
+        >>> v1.observe(p("V1"))
+        >>> v2.observe(p("V2"))
+        >>> v1.blocked.observe(p("V1 BLOCKED"))
+        >>> v2.blocked.observe(p("V2 BLOCKED"))
+        >>> linkVariables(v1,v2)
+        V2: 3
+        >>> print "v1: %r v2: %r"%(v1.value,v2.value)
+        v1: 3 v2: 3
+        >>> v1.value=6
+        V1: 6
+        V2: 6
+
+        When unblocking linked variables, the eventual value will come from the
+        one that is unblocked first.
+
+        Keep V2's value: 
+        >>> v2.block()
+        V2 BLOCKED: True
+        V1 BLOCKED: True
+        >>> v2.value=19
+        >>> v2.value=20
+        >>> v1.value=18
+        >>> v2.value=21
+        >>> v2.unblock()
+        V2: 21
+        V2 BLOCKED: False
+        V1: 21
+        V1 BLOCKED: False
+
+        Keep V1's value:
+        >>> with v1.updates_coalesced():  #Variables diverge while blocked. v1's value is kept
+        ...     v2.value=22
+        ...     v1.value=23
+        ...     v2.value=24
+        V1 BLOCKED: True
+        V2 BLOCKED: True
+        V1: 23
+        V1 BLOCKED: False
+        V2: 23
+        V2 BLOCKED: False
+
+        >>> 
+        >>> unlinkVariables(v1,v2) #Break the cycle for GC
+        >>> v1.value=7
+        V1: 7
+
+    """
+    v2.track_variable(v1)
+    v1.track_variable(v2)
+    
+def unlinkVariables(v1,v2):
+    v1.stop_tracking_variable(v2)
+    v2.stop_tracking_variable(v1)
+
+
+def _get_variable_constructors(attributes,defaultType=Variable):
+    """
+    Used internally by Algorithm constructor to handle the _inputs_ and _outputs_ lists
+
+    attributes: each attribute can be a string, which becomes a variable name, 
+                or tuple (name,constructor)
+    returns: a list of pairs (attributeName, Constructor)
+    """
+    def get_constructor(attr):
+        if type(attr) == tuple:
+            return(attr)
+        else:
+            return(attr,defaultType)
+        
+    return map(get_constructor,attributes)
+
+class _AlgorithmType(type):
+    """
+    Resolves an Algorithm class's `_inputs_` and `_outputs_` once, when the
+    class is created. With `_slots_` set, the ports declared by the class are
+    stored in slots and instances have no __dict__.
+    """
+    def __new__(meta,name,bases,namespace):
+        if namespace.get('_slots_') and '__slots__' not in namespace:
+            ports=[]
+            for attribute in ('_inputs_','_outputs_'):
+                declared=namespace.get(attribute,getattr(bases[0],attribute,()))
+                ports.extend(n for n,t in _get_variable_constructors(declared))
+            namespace['__slots__']=tuple(n for n in ports if not any(hasattr(b,n) for b in bases))
+        return type.__new__(meta,name,bases,namespace)
+
+    def __init__(cls,name,bases,namespace):
+        type.__init__(cls,name,bases,namespace)
+        cls._input_specs_=(cls._inputs_,tuple(_get_variable_constructors(cls._inputs_)))
+        cls._output_specs_=(cls._outputs_,tuple(_get_variable_constructors(cls._outputs_)))
+
+class Algorithm(object):
+    """
+    A container for input and output variables.  
+    To use, you must inherit from `Algorithm`   
+
+    Create class attributes `_inputs_` and `_outputs`, and the Algorithm default constructor will populate them with Variable() instances. 
+    Or initialize the variables yourself before calling the inherited constructor and it will leave them alone. 
+    
+    In either case, it will bind  inputs to call the update() function on change
+    It will also bind the valid flags to update into a central _valid_ object on the instance. 
+
+    There is a central enable() flag that is set to true by default.
+    If you need to bind values into the inputs before running the algorithm,
+    then set it to true in the constructor or by setting the class variable
+    `_start_enabled_`
+
+    Set the class variable `_scheduled_` to hand updates to the module's
+    `propagator` instead of running them immediately. Scheduled Algorithms run
+    in topological order, once per change wave. See `Propagator`.
+
+    Set the class variable `_lazy_` to defer update() while none of the outputs
+    are observed. Input changes just set `updatePending`, and reading an output
+    runs the pending update first. Once an output is observed (including by a
+    downstream Algorithm or tracking Variable) the Algorithm updates eagerly.
+
+    Instead of update(), you can implement compute(*input_values), returning
+    the output value (or a tuple of values if there are several outputs).
+    Scheduled Algorithms that also set `_parallel_` can then run concurrently
+    on the propagator's executor. See `Propagator`.
+
+    Set `_memoize_` to a cache size to memoize an Algorithm whose outputs
+    depend only on its input values. See `__test_memoize`.
+
+    Set `_slots_` to store the ports in slots, for Algorithms created by the
+    hundred thousand. Instances then can't have other attributes, unless the
+    class lists them in `__slots__` itself. create_many() builds and wires many
+    instances in one call. See `__test_create_many`.
+
+    When every input carries a `version` (VersionedVariable, VariableArray),
+    the Algorithm remembers the versions it last updated from and skips
+    update() until one of them changes. Call update() directly to force a run.
+
+        Define a pretty printer for this example 
+        >>> def p(name):
+        ...     def q(value):
+        ...         print "%s: %r"%(name,value)
+        ...     return q
+
+        Your code goes in a subclass of Algorithm
+        >>> class  Adder(Algorithm):
+        ...     _inputs_=('a','b')
+        ...     _outputs_=('c',)
+        ...     _start_enabled_=False
+        ...
+        ...     def update(self):
+        ...         self.c.value = self.a.value + self.b.value
+
+        Input and output variables are automatically created
+        >>> adder=Adder()
+        >>> adder.a.observe(p("a"))
         >>> adder.b.observe(p("b"))
         >>> adder.c.observe(p("c"))
         >>> adder.a.value=1
@@ -580,77 +1960,2117 @@ class Algorithm(object):
         AttributeError: 'NoneType' object has no attribute 'value'
 
     """
-    __slots__=("_inputs_","_outputs_","inputs","outputs","enabled","outputs_blocked")
-    __variableType__=Variable
-    _start_enabled_=True
-    _outputs_=tuple()
-    _inputs_=tuple()
-    
-    def __init__(self,enabled=None,**kwargs):
-        if enabled is None:
-            enabled=self._start_enabled_
+    __metaclass__=_AlgorithmType
+    __slots__=("_inputs_","_outputs_","inputs","outputs","enabled","outputs_blocked","_queued","_depth","_input_versions",
+               "updatePending","_memo","memo_hits","memo_misses","__weakref__")
+    __variableType__=Variable
+    _start_enabled_=True
+    _scheduled_=False
+    _lazy_=False
+    _parallel_=False
+    compute=None
+    _memoize_=0
+    _memo_key_=staticmethod(tuple)
+    _outputs_=tuple()
+    _inputs_=tuple()
+    
+    def __init__(self,enabled=None,**kwargs):
+        if enabled is None:
+            enabled=self._start_enabled_
+
+        self.updatePending=False
+        self._queued=False
+        self._depth=None
+        self._input_versions=None
+        self.memo_hits=self.memo_misses=0
+        self.outputs_blocked=Observable(False)
+        
+        self.enabled=Observable(enabled)
+        self.enabled.observe(self.check_blocks_and_update)
+        
+        self.inputs=self._create_ports(self._inputs_,self._input_specs_,kwargs)
+        for inputVariable in self.inputs:
+            inputVariable.blocked.observe(self.check_blocks_and_update)
+            inputVariable.observe(self.check_blocks_and_update)
+
+        self.outputs=self._create_ports(self._outputs_,self._output_specs_,kwargs)
+        for outputVariable in self.outputs:
+            outputVariable._producer=self
+            self.outputs_blocked.observe(outputVariable.setBlocked)
+
+        if self.inputs and all(hasattr(i,'version') for i in self.inputs):
+            self._input_versions=()  # never updated
+        if self._scheduled_:
+            propagator._track_scheduled(self)
+            
+        self.check_blocks_and_update()
+   
+    def _create_ports(self,declared,resolved,kwargs):
+        """
+        The port Variables: attributes set before the constructor ran are
+        kept, the rest are constructed from kwargs or with no value
+        """
+        source,specs=resolved
+        if declared is not source:  # set on the instance
+            assert isinstance(declared,(tuple,list))
+            specs=_get_variable_constructors(declared)
+        ports=[]
+        for attrName,constructor in specs:
+            variable=getattr(self,attrName,_MISSING)
+            if variable is _MISSING:
+                variable=constructor(kwargs[attrName]) if attrName in kwargs else constructor()
+                setattr(self,attrName,variable)
+            ports.append(variable)
+        return ports
+
+    @classmethod
+    def create_many(cls,count=None,enabled=None,**ports):
+        """
+        Create count instances. Each keyword names a port and gives a sequence
+        with an item per instance: Variables are tracked, anything else is the
+        initial value. count defaults to the length of the sequences.
+        """
+        columns=[(name,list(items)) for name,items in sorted(ports.items())]
+        lengths=set(len(items) for name,items in columns)
+        if count is None and len(lengths) < 2:
+            count=lengths.pop() if lengths else 0
+        if lengths-set([count]):
+            raise ValueError("Expected %s items for each port, got %s"%(
+                "as many" if count is None else count,', '.join("%s=%d"%(name,len(items)) for name,items in columns)))
+        algorithms=[]
+        for n in range(count):
+            kwargs={}
+            links=[]
+            for name,items in columns:
+                item=items[n]
+                if isinstance(item,Variable):
+                    kwargs[name]=item.value  # so the first update sees the tracked value
+                    links.append((name,item))
+                else:
+                    kwargs[name]=item
+            algorithm=cls(enabled,**kwargs)
+            for name,source in links:
+                getattr(algorithm,name).track_variable(source)
+            algorithms.append(algorithm)
+        return algorithms
+
+    def update(self):
+        if self.compute is not None:
+            self._set_outputs(self.compute(*[i.value for i in self.inputs]))
+
+    def _set_outputs(self,result):
+        if len(self.outputs) == 1:
+            result=(result,)
+        for output,value in zip(self.outputs,result):
+            output.value=value
+    
+    def check_blocks_and_update(self,dummy=None):
+        isBlocked=self.is_blocked()
+        if isBlocked or not (self._scheduled_ or propagator._schedule_all):
+            self._apply_update(isBlocked)
+        else:
+            propagator.schedule(self)
+
+    def is_blocked(self):
+        if not self.enabled.value:
+            return True
+        for i in self.inputs:
+            if i.is_blocked():
+                return True
+        return False
+
+    def _apply_update(self,isBlocked):
+        if not isBlocked:
+            if self._lazy_ and self._deferred():
+                self.updatePending=True
+            else:
+                self.updatePending=False
+                self._run_update()
+
+        self.outputs_blocked.value = isBlocked
+
+    def _run_update(self):
+        if self._input_versions is None and not self._memoize_ and _profiler is None:
+            self.update()
+            return
+        versions=self._inputs_changed()
+        if versions is None:
+            return
+        profiler=_profiler
+        if profiler is not None:
+            profiler._enter(self)
+        try:
+            if not self._memoize_:
+                self.update()
+            else:
+                key=self._memo_lookup()
+                if key is not None:
+                    self.update()
+                    self._memo_store(key)
+        finally:
+            if profiler is not None:
+                profiler._exit()
+        self._updated_from(versions)
+
+    def _inputs_changed(self):
+        """
+        The current input versions, or None if they match the last update.
+        Returns () for Algorithms without versioned inputs
+        """
+        if self._input_versions is None:
+            return ()
+        versions=tuple(i.version for i in self.inputs)
+        if versions == self._input_versions:
+            return None
+        return versions
+
+    def _updated_from(self,versions):
+        if versions:
+            self._input_versions=versions
+
+    def _memo_lookup(self):
+        """
+        On a cache hit, set the outputs from the cache and return None.
+        Otherwise return the key to store the result under (_UNCACHEABLE if
+        the inputs can't be used as a key)
+        """
+        memo=getattr(self,'_memo',None)
+        if memo is None:
+            memo=self._memo=collections.OrderedDict()
+        key=self._memo_key_([i.value for i in self.inputs])
+        try:
+            cached=memo.pop(key)
+        except KeyError:
+            pass
+        except TypeError:
+            self.memo_misses+=1
+            return _UNCACHEABLE
+        else:
+            memo[key]=cached
+            self.memo_hits+=1
+            for output,value in zip(self.outputs,cached):
+                output.value=value
+            return None
+        self.memo_misses+=1
+        return key
+
+    def _memo_store(self,key):
+        if key is _UNCACHEABLE:
+            return
+        memo=self._memo
+        memo[key]=tuple(o.value for o in self.outputs)
+        while len(memo) > self._memoize_:
+            memo.popitem(last=False)
+
+    def clear_memo(self):
+        self._memo=collections.OrderedDict()
+
+    def _restored(self):
+        # The outputs were just restored from a snapshot of the same inputs
+        if self._input_versions is not None:
+            self._input_versions=tuple(i.version for i in self.inputs)
+
+    def _deferred(self):
+        # A lazy Algorithm defers updates while none of its outputs are observed
+        return self._lazy_ and not any(o._observers is not None for o in self.outputs)
+
+    def refresh(self):
+        """
+        Run a pending lazy update now, unless the Algorithm is blocked
+        """
+        if self.updatePending and not self.is_blocked():
+            self.updatePending=False
+            self._run_update()
+        
+
+    def observe(self,attribute,callback):
+        getattr(self,'_' + attribute).observe(callback)
+        
+    def unobserve(self,attribute,callback):
+        getattr(self,'_' + attribute).unobserve(callback)
+        
+    def get(varname,self):
+        variable=getattr(self,varname)
+        return variable.value
+    
+    def set(varname,self,value):
+        variable=getattr(self,varname)
+        variable.value=value
+
+def _downstream_algorithms(algorithm):
+    """
+    Yield the Algorithms fed by algorithm's outputs, following track_variable links.
+    Discovered by walking the observer lists, so it always reflects the current wiring.
+    """
+    seen=set()
+    pending=list(algorithm.outputs)
+    while pending:
+        variable=pending.pop()
+        if id(variable) in seen:
+            continue
+        seen.add(id(variable))
+        for callback in variable.observers:
+            target=getattr(callback,'__self__',None)
+            if isinstance(target,Algorithm):
+                yield target
+            elif isinstance(target,Variable):
+                pending.append(target)
+
+class Propagator(object):
+    """
+    Runs scheduled Algorithms in topological order, so that each one updates
+    once per change wave, after everything upstream of it has settled.
+
+    An Algorithm's depth is the length of the longest chain of Algorithms
+    downstream of it. Anything upstream of an Algorithm is strictly deeper, so
+    draining the deepest dirty Algorithm first never exposes an intermediate
+    value. Depths are discovered from the observer wiring and cached until the
+    wiring changes.
+
+    While a scheduled Algorithm exists, notifications hold the propagator
+    open, so the queue is drained once the outermost notification returns.
+    Otherwise they just call their observers. Use wave() to hold it across
+    several sets.
+
+    Thread safety: the graph itself is not locked. To change it from several
+    threads, pass every change through submit(), e.g. submit(v.set,3) or
+    submit(v.block). Submissions are queued without locking, and whichever
+    thread finds the propagator idle applies everything queued so far in one
+    transaction. So callbacks run one wave at a time, on one of the
+    submitting threads. An uncontended submit costs a deque append and a
+    non-blocking lock acquire. flush() waits for batches still being applied
+    elsewhere. If a submission raises, the others in its batch still apply and
+    the error goes to its submitter, from submit() or its result(). See
+    `__test_threads`.
+
+    Iterative propagation: set `iterative` to notify observers from a loop
+    instead of recursively, so the stack depth doesn't grow with the graph.
+    Observers are called in the same order. The difference is that
+    notifications made by a callback are queued until it returns, so code
+    after a set in an observer or update() runs before anything downstream
+    of that set. See `__test_iterative`.
+
+    Parallel updates: set `executor` to a pool with a map() method, such as
+    multiprocessing.Pool, multiprocessing.pool.ThreadPool or a
+    concurrent.futures executor. Algorithms of the same depth can't depend on
+    each other, so when several queued ones at the deepest level set
+    `_parallel_` and implement compute(), their compute() calls are mapped over
+    the pool together. Results are applied in queue order. For process pools,
+    make compute a staticmethod or classmethod of a module-level class, with
+    picklable inputs and results.
+
+        >>> from multiprocessing.pool import ThreadPool
+        >>> class Square(Algorithm):
+        ...     _inputs_=('x',)
+        ...     _outputs_=('y',)
+        ...     _scheduled_=True
+        ...     _parallel_=True
+        ...     def compute(self,x):
+        ...         return x*x
+        >>> source=Variable(1)
+        >>> squares=[Square(x=1) for i in range(4)]
+        >>> for n,square in enumerate(squares):
+        ...     square.x.track_variable(source)
+        ...     square.y.observe(pp("square %d"%n))
+        >>> propagator.executor=ThreadPool(2)
+        >>> source.value=3
+        square 0: 9
+        square 1: 9
+        square 2: 9
+        square 3: 9
+        >>> propagator.executor.terminate()
+
+        If the pool can't take the jobs, e.g. they don't pickle, they run here
+        >>> import pickle
+        >>> class Unpicklable(object):
+        ...     def map(self,func,jobs):
+        ...         raise pickle.PicklingError("can't pickle")
+        >>> propagator.executor=Unpicklable()
+        >>> source.value=4
+        square 0: 16
+        square 1: 16
+        square 2: 16
+        square 3: 16
+
+        Also when the error only comes out of the results, as with concurrent.futures
+        >>> class Lazy(object):
+        ...     def map(self,func,jobs):
+        ...         for job in jobs:
+        ...             raise pickle.PicklingError("can't pickle")
+        ...             yield
+        >>> propagator.executor=Lazy()
+        >>> source.value=5
+        square 0: 25
+        square 1: 25
+        square 2: 25
+        square 3: 25
+        >>> propagator.executor=None
+
+        Define a pretty printer for this example
+        >>> def p(name):
+        ...     def q(value):
+        ...         print "%s: %r"%(name,value)
+        ...     return q
+
+        A diamond: v1->(double,increment)->total
+        >>> class Double(Algorithm):
+        ...     _inputs_=('a',)
+        ...     _outputs_=('c',)
+        ...     _scheduled_=True
+        ...     def update(self):
+        ...         self.c.value=self.a.value*2
+        >>> class Increment(Double):
+        ...     def update(self):
+        ...         self.c.value=self.a.value+1
+        >>> class Total(Algorithm):
+        ...     _inputs_=('a','b')
+        ...     _outputs_=('c',)
+        ...     _scheduled_=True
+        ...     def update(self):
+        ...         print "total runs: %r + %r"%(self.a.value,self.b.value)
+        ...         self.c.value=self.a.value+self.b.value
+
+        >>> v1=Variable(1)
+        >>> double,increment=Double(a=0),Increment(a=0)
+        >>> double.a.track_variable(v1)
+        >>> increment.a.track_variable(v1)
+        >>> total=Total(a=0,b=0)
+        total runs: 0 + 0
+        >>> total.a.track_variable(double.c)
+        total runs: 2 + 0
+        >>> total.b.track_variable(increment.c)
+        total runs: 2 + 2
+        >>> total.c.observe(p("total"))
+
+        Total runs once per change, and never sees half of the wave
+        >>> v1.value=5
+        total runs: 10 + 6
+        total: 16
+        >>> propagator.depth(double), propagator.depth(total)
+        (1, 0)
+
+        wave() holds updates until the block exits
+        >>> v2=Variable(0)
+        >>> increment.a.stop_tracking_variable(v1)
+        >>> increment.a.track_variable(v2)
+        total runs: 10 + 1
+        total: 11
+        >>> with propagator.wave():
+        ...     v1.value=2
+        ...     v2.value=2
+        total runs: 4 + 3
+        total: 7
+
+        Blocking still works as before
+        >>> with v1.updates_coalesced():
+        ...     v1.value=3
+        ...     v1.value=4
+        total runs: 8 + 3
+        total: 11
+
+        A failing update doesn't leave the rest of its wave queued
+        >>> class Fail(Double):
+        ...     def update(self):
+        ...         if self.a.value == 5:
+        ...             raise ValueError("failed")
+        >>> fail=Fail(a=0)
+        >>> fail.a.track_variable(v1)
+        >>> v1.value=5
+        Traceback (most recent call last):
+            ...
+        ValueError: failed
+        >>> propagator._queue, total.c.value
+        ([], 13)
+    """
+    def __init__(self):
+        self._queue=[]
+        self._holds=0
+        self._schedule_all=0
+        self._draining=False
+        self._counter=itertools.count()
+        self._submissions=collections.deque()
+        self._submit_lock=threading.Lock()
+        self._applied=threading.Condition(threading.Lock())
+        self._applier=None
+        self._last_submission=None
+        self.executor=None
+        self._iterative=False
+        self._holding=False   # whether notifications hold the queue
+        self._scheduled=set() # weak references to the live scheduled Algorithms
+        self._deferred=None   # notifications queued by the running callback, when iterative
+
+    @property
+    def iterative(self):
+        return self._iterative
+
+    @iterative.setter
+    def iterative(self,iterative):
+        self._iterative=iterative
+        _refresh_notify()
+
+    def _track_scheduled(self,algorithm):
+        # Notifications hold the queue until they return while a scheduled Algorithm is alive
+        self._scheduled.add(weakref.ref(algorithm,self._scheduled_collected))
+        if not self._holding:
+            self._holding=True
+            _refresh_notify()
+
+    def _scheduled_collected(self,ref):
+        self._scheduled.discard(ref)
+        if not self._scheduled:
+            self._holding=False
+            _refresh_notify()
+
+    def schedule(self,algorithm):
+        """
+        Queue algorithm to run in this wave. Queuing an Algorithm twice is a no-op.
+        """
+        if not algorithm._queued:
+            algorithm._queued=True
+            heapq.heappush(self._queue,(-self.depth(algorithm),next(self._counter),algorithm))
+        if not self._holds:
+            self.drain()
+
+    def drain(self):
+        """
+        Run queued Algorithms, deepest first, until the queue is empty.
+        If an update raises, the rest still run, then the first error is raised
+        """
+        if self._draining:
+            return
+        self._draining=True
+        error=None
+        try:
+            queue=self._queue
+            while queue:
+                try:
+                    # After an error, one at a time: a level that failed is requeued whole
+                    if error is None and self.executor is not None and queue[0][2]._parallel_:
+                        self._drain_level()
+                    else:
+                        algorithm=heapq.heappop(queue)[2]
+                        algorithm._queued=False
+                        algorithm._apply_update(algorithm.is_blocked())
+                except Exception:
+                    if error is None:
+                        error=sys.exc_info()
+        finally:
+            self._draining=False
+        if error is not None:
+            raise error[0],error[1],error[2]
+
+    def _drain_level(self):
+        # Run every Algorithm queued at the deepest level, mapping compute() over the executor
+        queue=self._queue
+        level=queue[0][0]
+        batch=[]
+        while queue and queue[0][0] == level:
+            algorithm=heapq.heappop(queue)[2]
+            algorithm._queued=False
+            batch.append(algorithm)
+
+        # Whatever hasn't been reached when something raises goes back on the
+        # queue, as it would have stayed there in a serial drain
+        done=0
+        try:
+            parallel=[]
+            keys={}
+            versions={}
+            for a in batch:
+                if a._parallel_ and a.compute is not None and not a.is_blocked() and not a._deferred():
+                    current=versions[a]=a._inputs_changed()
+                    if current is None:
+                        keys[a]=None  # unchanged, nothing to do
+                        a.updatePending=False
+                        a.outputs_blocked.value=False
+                        continue
+                    if a._memoize_:
+                        key=keys[a]=a._memo_lookup()
+                        if key is None:
+                            a._updated_from(current)
+                            a.updatePending=False
+                            a.outputs_blocked.value=False
+                            continue
+                    parallel.append(a)
+            jobs=[(_compute_target(a),[i.value for i in a.inputs]) for a in parallel]
+            if len(jobs) > 1:
+                try:
+                    # list(): concurrent.futures raise from the iterator, not from map()
+                    results=list(self.executor.map(_call_compute,jobs))
+                except Exception:
+                    # e.g. a PicklingError from a process pool: run them here instead
+                    results=[_call_compute(job) for job in jobs]
+            else:
+                results=[_call_compute(job) for job in jobs]
+            results=dict(zip(parallel,results))
+
+            profiler=_profiler
+            for algorithm in batch:
+                done+=1
+                if algorithm in results:
+                    algorithm.updatePending=False
+                    if profiler is not None:
+                        profiler._enter(algorithm)
+                    try:
+                        algorithm._set_outputs(results[algorithm])
+                    finally:
+                        if profiler is not None:
+                            profiler._exit()
+                    if algorithm in keys:
+                        algorithm._memo_store(keys[algorithm])
+                    algorithm._updated_from(versions[algorithm])
+                    algorithm.outputs_blocked.value=False
+                elif algorithm not in keys:
+                    algorithm._apply_update(algorithm.is_blocked())
+        except:
+            for algorithm in batch[done:]:
+                if not algorithm._queued:
+                    algorithm._queued=True
+                    heapq.heappush(queue,(level,next(self._counter),algorithm))
+            raise
+
+    @contextmanager
+    def wave(self,schedule_all=False):
+        """
+        Hold the queue until the block exits.
+        With schedule_all, unscheduled Algorithms triggered in the wave are queued too
+        """
+        self._holds+=1
+        self._schedule_all+=schedule_all
+        try:
+            try:
+                yield
+            finally:
+                self._holds-=1
+            if not self._holds and self._queue:
+                self.drain()
+        finally:
+            self._schedule_all-=schedule_all
+
+    def _after(self,func,value):
+        # func(value), after any notifications the running callback has queued
+        deferred=self._deferred
+        if deferred is not None:
+            deferred.append([None,value,(func,),-1,False])
+        else:
+            func(value)
+
+    def _run_notifications(self,frame):
+        # Depth first, like recursive notification: what a callback queued runs
+        # before the next callback, in the order it was queued
+        profiler=_profiler
+        deferred=self._deferred=[]
+        frames=[frame]
+        self._holds+=1
+        try:
+            while frames:
+                frame=frames[-1]
+                observable,value,entries,i,dead=frame
+                if i < 0:
+                    i=0
+                    if profiler is not None and observable is not None:
+                        profiler._notifying(observable,observable._observers)
+                if i == len(entries):
+                    frames.pop()
+                    if observable is not None:
+                        if dead:
+                            observable._prune_observers()
+                        if profiler is not None:
+                            profiler._notified()
+                    continue
+                frame[3]=i+1
+                callback=entries[i]
+                if callback is not None and callback(value) is _DEAD:
+                    frame[4]=True
+                if deferred:
+                    deferred.reverse()
+                    frames.extend(deferred)
+                    del deferred[:]
+        finally:
+            self._deferred=None
+            self._holds-=1
+            if profiler is not None:
+                for frame in frames:
+                    if frame[0] is not None and frame[3] >= 0:
+                        profiler._notified()
+        if not self._holds and self._queue:
+            self.drain()
+
+    def after_wave(self,func):
+        """
+        Call func() once the Algorithms queued in the current wave have run,
+        or now if nothing is propagating
+        """
+        heapq.heappush(self._queue,(float('inf'),next(self._counter),_WaveCallback(func)))
+        if not self._holds:
+            self.drain()
+
+    def submit(self,func,*args):
+        """
+        Thread-safe func(*args), for changes to the graph such as v.set or v.block.
+        Runs now, unless another thread is already applying submissions, in
+        which case that thread runs it before it finishes. Returns a
+        _Submission; if func raised, so does its result(), and so does submit()
+        if it has already been applied by then.
+        """
+        submission=_Submission(self,func,args)
+        self._submissions.append(submission)
+        self._last_submission=submission
+        self._apply_submissions()
+        if submission._error is not None:
+            submission.result()
+        return submission
+
+    def flush(self):
+        """
+        Wait until everything submitted so far has been applied, including
+        batches another thread is still applying
+        """
+        last=self._last_submission
+        self._apply_submissions()
+        if last is not None and not last._done:
+            if self._applier is threading.current_thread():
+                return  # called from a submission: the rest follow once it returns
+            last._wait()
+
+    def _apply_submissions(self):
+        submissions=self._submissions
+        # Re-check after releasing: another thread may have queued work while
+        # we held the lock, and given up because we held it
+        while submissions and self._submit_lock.acquire(False):
+            self._applier=threading.current_thread()
+            try:
+                while submissions:
+                    batch=[]
+                    try:
+                        while True:
+                            batch.append(submissions.popleft())
+                    except IndexError:
+                        pass
+                    self._apply_batch(batch)
+            finally:
+                self._applier=None
+                self._submit_lock.release()
+
+    def _apply_batch(self,batch):
+        # One transaction, but each submission fails on its own: its error is
+        # kept for its submitter, and the others still apply. Changes it made
+        # before raising are applied with the rest.
+        try:
+            with transaction():
+                for submission in batch:
+                    try:
+                        submission.func(*submission.args)
+                    except Exception:
+                        submission._error=sys.exc_info()
+        except Exception:
+            error=sys.exc_info()
+            for submission in batch:
+                if submission._error is None:
+                    submission._error=error
+        with self._applied:
+            for submission in batch:
+                submission._done=True
+            self._applied.notify_all()
+
+    def depth(self,algorithm):
+        """
+        Length of the longest chain of Algorithms downstream of algorithm.
+        Cycles (e.g. from linkVariables) are cut where they are found.
+        """
+        version=_structure_version
+        cached=algorithm._depth
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+        depths={algorithm:0}
+        stack=[(algorithm,_downstream_algorithms(algorithm))]
+        while stack:
+            node,children=stack[-1]
+            for child in children:
+                cached=child._depth
+                if cached is not None and cached[0] == version:
+                    depths[node]=max(depths[node],cached[1]+1)
+                elif child not in depths:
+                    depths[child]=0
+                    stack.append((child,_downstream_algorithms(child)))
+                    break
+            else:
+                stack.pop()
+                node._depth=(version,depths[node])
+                if stack:
+                    parent=stack[-1][0]
+                    depths[parent]=max(depths[parent],depths[node]+1)
+        return algorithm._depth[1]
+
+class _Submission(object):
+    """
+    A change queued with Propagator.submit(). result() waits until it has been
+    applied, and raises whatever it raised.
+    """
+    __slots__=('_propagator','func','args','_done','_error')
+
+    def __init__(self,propagator,func,args):
+        self._propagator=propagator
+        self.func=func
+        self.args=args
+        self._done=False
+        self._error=None
+
+    def done(self):
+        return self._done
+
+    def result(self):
+        if not self._done:
+            self._wait()
+        error=self._error
+        if error is not None:
+            raise error[0],error[1],error[2]
+
+    def _wait(self):
+        propagator=self._propagator
+        if propagator._applier is threading.current_thread():
+            raise RuntimeError("can't wait for a submission from inside another one")
+        with propagator._applied:
+            while not self._done:
+                propagator._applied.wait()
+
+class _WaveCallback(object):
+    # Propagator queue entry for after_wave(). Queued last, and run like an Algorithm
+    __slots__=('func','_queued')
+    _parallel_=False
+
+    def __init__(self,func):
+        self.func=func
+        self._queued=True
+
+    def is_blocked(self):
+        return False
+
+    def _apply_update(self,isBlocked):
+        self.func()
+
+propagator=Propagator()
+
+def _refresh_notify():
+    global _full_notify
+    _full_notify=bool(propagator._holding or propagator._iterative or _profiler is not None)
+
+def _compute_target(algorithm):
+    # The instance, unless compute is a static or class method: then the class, which pickles
+    compute=type(algorithm).compute
+    return algorithm if getattr(compute,'__self__',False) is None else type(algorithm)
+
+def _call_compute(job):
+    target,values=job
+    return target.compute(*values)
+
+def compile_graph(roots):
+    """
+    Precompute the update schedule downstream of the source Variables in roots.
+    See `CompiledGraph`
+    """
+    return CompiledGraph(roots)
+
+_variable_set=Variable.set.__func__
+_algorithm_apply_update=Algorithm._apply_update.__func__
+
+def _callback_target(callback):
+    # The object and function behind a bound (or weakly held) observer
+    if isinstance(callback,_WeakCallback):
+        return callback.__self__,callback._func
+    return getattr(callback,'__self__',None),getattr(callback,'__func__',None)
+
+class CompiledGraph(object):
+    """
+    A flat, topologically ordered schedule of the Algorithm updates and
+    tracking links downstream of some source Variables. Setting a source
+    through the graph runs the schedule as a loop, instead of discovering the
+    path through nested notifications. Everything downstream sees the new
+    values in the same order as a scheduled Propagator wave.
+
+    The schedule is rebuilt on the next set after an observe() or unobserve()
+    on a Variable it covers. Rewiring elsewhere only costs a check of the
+    covered Variables' stamps. Graphs with cycles, e.g. from linkVariables, can't be
+    compiled.
+
+    Inside the graph, Variables that feed other parts of it only collect
+    their changes while the schedule runs. Their other observers are notified
+    once it has finished, in schedule order. Blocked Variables, lazy and
+    asynchronous Algorithms behave as usual. Inside a transaction, sets are
+    passed through to the sources. Don't rewire the graph from its own updates.
+
+        >>> class Double(Algorithm):
+        ...     _inputs_=('a',)
+        ...     _outputs_=('c',)
+        ...     def update(self):
+        ...         print "double %r"%self.a.value
+        ...         self.c.value=self.a.value*2
+        >>> class Total(Algorithm):
+        ...     _inputs_=('a','b')
+        ...     _outputs_=('c',)
+        ...     def update(self):
+        ...         print "total %r + %r"%(self.a.value,self.b.value)
+        ...         self.c.value=self.a.value+self.b.value
+        >>> x=Variable(1)
+        >>> first,total=Double(a=0),Total(a=0,b=0)
+        double 0
+        total 0 + 0
+        >>> first.a.track_variable(x)
+        double 1
+        >>> total.a.track_variable(first.c)
+        total 2 + 0
+        >>> total.b.track_variable(x)
+        total 2 + 1
+        >>> total.c.observe(pp("total"))
+        >>> graph=compile_graph([x])
+        >>> graph.schedule(x) == [first,total]
+        True
+
+        Total runs once, after Double, and its observers hear about it at the end
+        >>> graph.set(x,5)
+        double 5
+        total 10 + 5
+        total: 15
+
+        Rewiring is picked up on the next set
+        >>> second=Double(a=0)
+        double 0
+        >>> second.a.track_variable(total.c)
+        double 15
+        >>> graph.set(x,1)
+        double 1
+        total 2 + 1
+        double 3
+        total: 3
+        >>> graph.schedule(x) == [first,total,second]
+        True
+
+        Wiring outside the graph doesn't make it recompile
+        >>> plans=graph._plans
+        >>> Variable().observe(pp("elsewhere"))
+        >>> graph.set(x,2)
+        double 2
+        total 4 + 2
+        double 6
+        total: 6
+        >>> graph._plans is plans
+        True
+    """
+    def __init__(self,roots):
+        self.roots=list(roots)
+        self._changed=set()
+        self._version=None
+        self._compile()
+
+    def _compile(self):
+        self._version=_wiring_version
+        links={}   # Variable: (tracking callbacks, other observers, downstream nodes)
+        def successors(node):
+            if isinstance(node,Algorithm):
+                return node.outputs
+            if node not in links:
+                tracking,others,downstream=[],[],[]
+                for callback in node.observers:
+                    target,func=_callback_target(callback)
+                    if isinstance(target,Algorithm) and getattr(func,'__name__',None) == 'check_blocks_and_update':
+                        downstream.append(target)
+                    elif isinstance(target,Variable):
+                        tracking.append(callback)
+                        downstream.append(target)
+                    else:
+                        others.append(callback)
+                links[node]=(tracking,others,downstream)
+            return links[node][2]
+
+        # Depth first, from every root. Finished nodes, reversed, are in topological order
+        order=[]
+        state={}
+        for root in self.roots:
+            if root in state:
+                continue
+            state[root]=False
+            stack=[(root,iter(successors(root)))]
+            while stack:
+                node,children=stack[-1]
+                for child in children:
+                    finished=state.get(child)
+                    if finished is None:
+                        state[child]=False
+                        stack.append((child,iter(successors(child))))
+                        break
+                    elif not finished:
+                        raise ValueError("Can't compile a graph with a cycle through %r"%(child,))
+                else:
+                    stack.pop()
+                    state[node]=True
+                    order.append(node)
+        order.reverse()
+        position=dict((node,n) for n,node in enumerate(order))
+
+        self._plans={}
+        for root in self.roots:
+            reachable=set([root])
+            pending=[root]
+            while pending:
+                for child in successors(pending.pop()):
+                    if child not in reachable:
+                        reachable.add(child)
+                        pending.append(child)
+            self._plans[root]=self._plan(sorted(reachable,key=position.get),links)
+        self._plan_all=self._plan(order,links)
+        self._covered=tuple(links)
+
+    def _check_wiring(self):
+        # Recompile if any Variable in the graph has been rewired since the last compile
+        version=self._version
+        for variable in self._covered:
+            if variable._wired > version:
+                self._compile()
+                return
+        self._version=_wiring_version
+
+    def _plan(self,nodes,links):
+        # steps: (True, Variable, (fed, plain, other) tracking callbacks) or (False, Algorithm, (inputs, plain))
+        # interior: (Variable, change recorder, other observers) for Variables feeding the graph
+        steps=[]
+        interior=[]
+        recorders=dict((node,self._recorder(node)) for node in nodes
+                       if not isinstance(node,Algorithm) and links[node][2])
+        for node in nodes:
+            if isinstance(node,Algorithm):
+                # Plain eager Algorithms without memos skip the blocked flag bookkeeping while nothing is blocked
+                plain=(type(node)._apply_update.__func__ is _algorithm_apply_update
+                       and not node._lazy_ and not node._memoize_)
+                steps.append((False,node,(tuple(node.inputs),plain)))
+            elif node in recorders:
+                tracking,others,downstream=links[node]
+                if tracking:
+                    # Plain Variable.set links are assigned directly. Those into the
+                    # graph just record the change, as their notification would
+                    plain=[c for c in tracking if _callback_target(c)[1] is _variable_set]
+                    fed=tuple((c,recorders[c.__self__]) for c in plain if c.__self__ in recorders)
+                    steps.append((True,node,(fed,tuple(c for c in plain if c.__self__ not in recorders),
+                                             tuple(c for c in tracking if c not in plain))))
+                interior.append((node,recorders[node],tuple(others)))
+        return steps,interior
+
+    def _recorder(self,variable):
+        mark=self._changed.add
+        def record(value):
+            mark(variable)
+        return record
+
+    def schedule(self,source):
+        """
+        The Algorithms a change to source updates, in order
+        """
+        if _wiring_version != self._version:
+            self._check_wiring()
+        return [node for is_variable,node,inputs in self._plans[source][0] if not is_variable]
+
+    def set(self,source,value):
+        self.update(((source,value),))
+
+    def update(self,changes):
+        """
+        Set several sources, given as a dict or (source, value) pairs, in one pass
+        """
+        changes=list(changes.items() if isinstance(changes,dict) else changes)
+        if _transaction_depth:
+            for source,value in changes:
+                source.set(value)
+            return
+        if _wiring_version != self._version:
+            self._check_wiring()
+        steps,interior=self._plans[changes[0][0]] if len(changes) == 1 else self._plan_all
+        changed=self._changed
+        direct=_profiler is None  # plain Algorithms without memos or versioned inputs just update()
+        with propagator.wave():
+            saved=[]
+            for variable,recorder,others in interior:
+                saved.append(variable._observers)
+                variable._observers=recorder
+            try:
+                for source,value in changes:
+                    source.set(value)
+                for is_variable,node,arg in steps:
+                    if is_variable:
+                        if node in changed:
+                            value=node._value
+                            fed,plain,other=arg
+                            for callback,recorder in fed:
+                                target=callback.__self__
+                                if target is None:
+                                    continue
+                                blocked=target._blocked
+                                if blocked is not None and blocked._value:
+                                    target.pendingValue=value
+                                elif target._assign(value):
+                                    if target._observers is recorder:
+                                        changed.add(target)
+                                    else:
+                                        target.notify_observers()
+                            for callback in plain:
+                                target=callback.__self__
+                                if target is None:
+                                    continue
+                                blocked=target._blocked
+                                if blocked is not None and blocked._value:
+                                    target.pendingValue=value
+                                elif target._assign(value):
+                                    target.notify_observers()
+                            for callback in other:
+                                callback(value)
+                    else:
+                        inputs,plain=arg
+                        for i in inputs:
+                            if i in changed:
+                                break
+                        else:
+                            continue
+                        if plain and node.enabled._value and not node.outputs_blocked._value:
+                            for i in inputs:
+                                blocked=i._blocked
+                                if blocked is not None and blocked._value:
+                                    break
+                            else:
+                                node.updatePending=False
+                                if direct and node._input_versions is None:
+                                    node.update()
+                                else:
+                                    node._run_update()
+                                continue
+                        node._apply_update(node.is_blocked())
+            finally:
+                for (variable,recorder,others),observers in zip(interior,saved):
+                    added=variable._observers
+                    variable._observers=observers
+                    if added is not recorder:
+                        for callback in (added if type(added) is _ObserverSet else [added]):
+                            if callback is not recorder:
+                                Observable.observe(variable,callback)
+                try:
+                    for variable,recorder,others in interior:
+                        if variable in changed:
+                            value=variable._value
+                            dead=False
+                            for callback in others:
+                                if callback(value) is _DEAD:
+                                    dead=True
+                            if dead:
+                                variable._prune_observers()
+                finally:
+                    changed.clear()
+
+class transaction(object):
+    """
+    Context manager (and decorator) that defers notifications from every
+    Variable set inside it until the outermost transaction exits.
+
+    Variables set in a transaction are held like blocked Variables, but
+    without notifying blocked observers. On commit all of their values are
+    applied first, then each changed Variable notifies its observers once, in
+    the order it was first set. Algorithms triggered by the commit run on the
+    propagator in topological order, so each runs once with consistent inputs.
+    block() and unblock() take effect on commit too: a Variable left blocked
+    keeps its new value pending.
+
+    If the outermost transaction exits with an exception, the pending values
+    are discarded. If an observer raises during the commit, the other
+    Variables still notify, and the first error is raised afterwards.
+
+        Define a pretty printer for this example
+        >>> def p(name):
+        ...     def q(value):
+        ...         print "%s: %r"%(name,value)
+        ...     return q
+
+        >>> v1,v2=Variable(1),Variable(2)
+        >>> v1.observe(p("v1"))
+        >>> v1.blocked.observe(p("v1 blocked"))
+        >>> v2.observe(p("v2"))
+        >>> v3=v1+v2
+        >>> v3.observe(p("v3"))
+
+        Reads inside the transaction see the new values
+        >>> with transaction():
+        ...     v1.value=10
+        ...     v1.value=11
+        ...     with transaction():
+        ...         v2.value=20
+        ...     print v1.value, v3.value
+        11 3
+        v1: 11
+        v2: 20
+        v3: 31
+
+        Use it as a decorator too
+        >>> @transaction()
+        ... def reset():
+        ...     v1.value=0
+        ...     v2.value=0
+        >>> reset()
+        v1: 0
+        v2: 0
+        v3: 0
+
+        Exceptions discard the transaction
+        >>> with transaction():
+        ...     v1.value=5
+        ...     raise ValueError("abandoned")
+        Traceback (most recent call last):
+            ...
+        ValueError: abandoned
+        >>> v1.value
+        0
+
+        An observer that raises doesn't stop the others
+        >>> def fail(value):
+        ...     raise RuntimeError("observer failed")
+        >>> v2.observe(fail)
+        >>> with transaction():
+        ...     v2.value=1
+        ...     v1.value=1
+        Traceback (most recent call last):
+            ...
+        RuntimeError: observer failed
+        >>> v2.unobserve(fail)
+        >>> v3.value
+        2
+
+        Blocking waits for the commit
+        >>> with transaction():
+        ...     v1.block()
+        ...     v1.value=6
+        ...     v2.unblock()
+        ...     v2.value=7
+        v2: 7
+        v1 blocked: True
+        >>> with transaction():
+        ...     v1.unblock()
+        ...     v1.value=8
+        v1: 8
+        v1 blocked: False
+        v3: 15
+    """
+    def __enter__(self):
+        global _transaction_depth
+        _transaction_depth+=1
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        global _transaction_depth
+        _transaction_depth-=1
+        if not _transaction_depth:
+            if exc_type is None:
+                _commit_transaction()
+            else:
+                _rollback_transaction()
+
+    def __call__(self,func):
+        @functools.wraps(func)
+        def transactional(*args,**kwargs):
+            with self:
+                return func(*args,**kwargs)
+        return transactional
+
+def _commit_transaction():
+    pending=_transaction_pending[:]
+    del _transaction_pending[:]
+    blocking=_transaction_blocking.copy()
+    _transaction_blocking.clear()
+
+    changed=[]
+    for v in pending:
+        if not v._release():
+            continue  # Someone unblocked it explicitly: already applied
+        if blocking.get(v):
+            continue  # Left blocked: the value stays pending
+        if v._assign(v.pendingValue):
+            changed.append(v)
+
+    # Every Variable notifies even if an observer raises: its value is
+    # already in place, so a later set to the same value would be dropped
+    error=None
+    with propagator.wave(schedule_all=True):
+        for v in changed:
+            try:
+                v.notify_observers()
+            except Exception:
+                if error is None:
+                    error=sys.exc_info()
+        for v,blocked in blocking.items():
+            try:
+                if not blocked:
+                    v.unblock()
+                elif not v.is_blocked():
+                    v.blocked.set(True)
+            except Exception:
+                if error is None:
+                    error=sys.exc_info()
+    if error is not None:
+        raise error[0],error[1],error[2]
+
+def _rollback_transaction():
+    pending=_transaction_pending[:]
+    del _transaction_pending[:]
+    _transaction_blocking.clear()
+    for v in pending:
+        if v._release():
+            v._discard()
+
+def _spawn_thread(func):
+    thread=threading.Thread(target=func)
+    thread.daemon=True
+    thread.start()
+
+#Finished AsyncAlgorithm runs, (algorithm, generation, result, exc_info or None), waiting for AsyncAlgorithm.poll()
+_async_results=collections.deque()
+_async_ready=threading.Condition(threading.Lock())
+
+class AsyncAlgorithm(Algorithm):
+    """
+    An Algorithm whose work runs in the background, so that slow calculations
+    (e.g. I/O) don't stall propagation.
+
+    Implement compute(*input_values), returning the output value, or a tuple
+    of values if there are several outputs. Each time the inputs change, the
+    outputs are blocked and compute() is handed to `_spawn_` with a snapshot of
+    the input values. `_spawn_` starts a daemon thread by default: set it to
+    e.g. a pool's apply_async to use a pool. If it returns something with a
+    cancel() method, that is called when the run is superseded.
+
+    The latest run wins: results from runs that were superseded by a newer
+    input change are dropped, and the outputs stay blocked until the latest
+    run's result is applied. Finished runs are queued, and applied on the
+    calling thread by AsyncAlgorithm.poll(), so observers never run on a
+    worker thread. If compute() raises, poll() raises the error once it has
+    applied the other results, the error is kept in `error`, and the outputs
+    stay blocked until the next input change.
+
+        Run the jobs by hand for this example
+        >>> jobs=[]
+        >>> class Lookup(AsyncAlgorithm):
+        ...     _inputs_=('key',)
+        ...     _outputs_=('price',)
+        ...     _spawn_=staticmethod(jobs.append)
+        ...     def compute(self,key):
+        ...         return key*100
+
+        >>> lookup=Lookup(key=1)
+        >>> lookup.price.observe(pp("price"))
+        >>> lookup.price.blocked.observe(pp("pending"))
+        >>> jobs.pop()()
+        >>> AsyncAlgorithm.poll()
+        price: 100
+        pending: False
+        1
+
+        >>> lookup.key.value=2
+        pending: True
+        >>> lookup.key.value=3
+        >>> stale,latest=jobs
+        >>> latest()
+        >>> stale()
+        >>> AsyncAlgorithm.poll()
+        price: 300
+        pending: False
+        1
+        >>> lookup.price.value
+        300
+
+        A failed run is reported by poll()
+        >>> lookup.key.value=None
+        pending: True
+        >>> jobs[-1]()
+        >>> AsyncAlgorithm.poll()
+        Traceback (most recent call last):
+            ...
+        TypeError: unsupported operand type(s) for *: 'NoneType' and 'int'
+        >>> print lookup.error
+        unsupported operand type(s) for *: 'NoneType' and 'int'
+        >>> lookup.price.is_blocked()
+        True
+
+        With real threads, wait for the results
+        >>> class Slow(AsyncAlgorithm):
+        ...     _inputs_=('x',)
+        ...     _outputs_=('y',)
+        ...     def compute(self,x):
+        ...         return x+1
+        >>> slow=Slow(x=1)
+        >>> slow.y.observe(pp("y"))
+        >>> while slow.y.is_blocked():
+        ...     _=AsyncAlgorithm.poll(1)
+        y: 2
+    """
+    _spawn_=staticmethod(_spawn_thread)
+
+    def __init__(self,enabled=None,**kwargs):
+        self._generation=0
+        self._job=None
+        self.error=None  # what the latest run's compute() raised, if it did
+        Algorithm.__init__(self,enabled,**kwargs)
+
+    def _apply_update(self,isBlocked):
+        self._supersede()
+        self.error=None
+        self.outputs_blocked.value=True
+        if not isBlocked:
+            generation=self._generation
+            values=[i.value for i in self.inputs]
+            self._job=self._spawn_(lambda: self._run(generation,values))
+
+    def _supersede(self):
+        self._generation+=1
+        job,self._job=self._job,None
+        if hasattr(job,'cancel'):
+            job.cancel()
+
+    @staticmethod
+    def poll(timeout=0):
+        """
+        Apply the results of the runs that have finished, waiting up to
+        timeout seconds for the first. Returns how many runs were handled:
+        results of superseded runs are dropped. If a latest run failed, its
+        error is raised once the rest have been applied
+        """
+        with _async_ready:
+            if not _async_results and timeout != 0:
+                _async_ready.wait(timeout)
+        applied=0
+        error=None
+        with transaction():
+            while _async_results:
+                algorithm,generation,result,failure=_async_results.popleft()
+                if algorithm._complete(generation,result,failure) and error is None:
+                    error=failure
+                applied+=1
+        if error is not None:
+            raise error[0],error[1],error[2]
+        return applied
+
+    def _run(self,generation,values):
+        if generation == self._generation:
+            failure=None
+            try:
+                result=self.compute(*values)
+            except Exception:
+                result,failure=None,sys.exc_info()
+            with _async_ready:
+                _async_results.append((self,generation,result,failure))
+                _async_ready.notify_all()
+
+    def _complete(self,generation,result,failure):
+        # Returns whether this was the latest run, and it failed
+        if generation != self._generation:
+            return False
+        self._job=None
+        if failure is not None:
+            self.error=failure[1]
+            return True
+        self._set_outputs(result)
+        self.outputs_blocked.value=False
+        return False
+
+class Profiler(object):
+    """
+    Records what propagation costs: update counts and update() times per
+    Algorithm, notification counts and fan-out per Observable, and how deeply
+    each wave of notifications nests. A wave starts at an outermost
+    notification.
+
+    Start it with start() or a with block. While no Profiler is running, the
+    hooks cost a global lookup per notification and update. The profiler
+    keeps references to everything it has seen until reset().
+
+    Objects are reported by label: "ClassName#n" in order of first
+    appearance, unless set with label(). update() times include everything
+    downstream that ran inside it, unless propagation is iterative. In the
+    collapsed stacks (for flamegraph.pl and friends) each frame is an
+    Algorithm, weighted by its own time in microseconds. For parallel updates
+    only applying the results is timed.
+
+        >>> ticks=itertools.count()
+        >>> profiler=Profiler(clock=lambda: next(ticks)*1e-6)
+        >>> class Double(Algorithm):
+        ...     _inputs_=('a',)
+        ...     _outputs_=('c',)
+        ...     def update(self):
+        ...         self.c.value=self.a.value*2
+        >>> first,second=Double(a=0),Double(a=0)
+        >>> second.a.track_variable(first.c)
+        >>> x=first.a
+        >>> profiler.label(first,"first")
+        >>> profiler.label(x,"x")
+        >>> with profiler:
+        ...     x.value=5
+        ...     x.value=6
+        >>> stats=profiler.stats()
+        >>> sorted(stats['algorithms'])
+        ['Double#1', 'first']
+        >>> stats['algorithms']['first']['updates'], stats['variables']['x']
+        (2, {'notifications': 2, 'fanout': 1})
+        >>> stats['waves']
+        {'count': 2, 'depths': {3: 2}, 'max_depth': 3}
+        >>> print profiler.collapsed()
+        first 4
+        first;Double#1 2
+        >>> profiler.reset()
+        >>> profiler.stats()['algorithms']
+        {}
+    """
+    def __init__(self,clock=timeit.default_timer):
+        self.clock=clock
+        self.reset()
+
+    def reset(self):
+        """
+        Forget everything recorded so far
+        """
+        self._labels={}
+        self._counts=collections.defaultdict(int)
+        self._algorithms={}   # Algorithm: [updates, total, max]
+        self._variables={}    # Observable: [notifications, fanout]
+        self._stacks=collections.defaultdict(float)
+        self._frames=[]       # [algorithm, start, time spent in nested updates]
+        self._depth=0
+        self._wave_depth=0
+        self._waves=collections.defaultdict(int)
+
+    def start(self):
+        global _profiler
+        _profiler=self
+        _refresh_notify()
+
+    def stop(self):
+        global _profiler
+        if _profiler is self:
+            _profiler=None
+            _refresh_notify()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self,*exc):
+        self.stop()
+
+    def label(self,obj,name):
+        self._labels[obj]=name
+
+    def _label(self,obj):
+        label=self._labels.get(obj)
+        if label is None:
+            name=type(obj).__name__
+            self._counts[name]+=1
+            label=self._labels[obj]="%s#%d"%(name,self._counts[name])
+        return label
+
+    def _notifying(self,observable,observers):
+        record=self._variables.get(observable)
+        if record is None:
+            record=self._variables[observable]=[0,0]
+            self._label(observable)
+        record[0]+=1
+        fanout=len(observers) if type(observers) is _ObserverSet else 1
+        if fanout > record[1]:
+            record[1]=fanout
+        self._depth+=1
+        if self._depth > self._wave_depth:
+            self._wave_depth=self._depth
+
+    def _notified(self):
+        self._depth-=1
+        if not self._depth:
+            self._waves[self._wave_depth]+=1
+            self._wave_depth=0
+
+    def _enter(self,algorithm):
+        self._frames.append([algorithm,self.clock(),0.0])
+
+    def _exit(self):
+        algorithm,start,nested=self._frames[-1]
+        elapsed=self.clock()-start
+        record=self._algorithms.get(algorithm)
+        if record is None:
+            record=self._algorithms[algorithm]=[0,0.0,0.0]
+        record[0]+=1
+        record[1]+=elapsed
+        record[2]=max(record[2],elapsed)
+        self._stacks[';'.join(self._label(frame[0]) for frame in self._frames)]+=elapsed-nested
+        self._frames.pop()
+        if self._frames:
+            self._frames[-1][2]+=elapsed
+
+    def stats(self):
+        """
+        Everything recorded so far, as a dict of plain types
+        """
+        waves=self._waves
+        return {
+            'algorithms': dict((self._label(a),{'updates': n, 'total': total, 'max': longest})
+                               for a,(n,total,longest) in self._algorithms.items()),
+            'variables': dict((self._label(v),{'notifications': n, 'fanout': fanout})
+                              for v,(n,fanout) in self._variables.items()),
+            'waves': {'count': sum(waves.values()), 'max_depth': max(waves) if waves else 0, 'depths': dict(waves)},
+        }
+
+    def to_json(self,**kwargs):
+        return json.dumps(self.stats(),**kwargs)
+
+    def collapsed(self):
+        """
+        The update stacks in collapsed format, one "frame;frame weight" per line
+        """
+        return '\n'.join("%s %d"%(stack,round(seconds*1e6)) for stack,seconds in sorted(self._stacks.items()))
+
+#Change log: a magic line, then records of kind, Variable id, time and payload length, then the payload
+_LOG_MAGIC=b"observer log 1\n"
+_LOG_RECORD=struct.Struct('<BIdI')
+_LOG_DEFINE,_LOG_VALUE,_LOG_BLOCK,_LOG_UNBLOCK=range(4)
+
+class Recorder(object):
+    """
+    Appends the changes of some source Variables to a binary log, so they can
+    be replayed into a freshly built graph with replay().
+
+    variables maps a stable name to each Variable. The log refers to them by
+    number, and defines the numbers by name each time a recording starts.
+    Recording starts with the current values and blocked flags, then adds a
+    record per notification. Sets that don't change the value, and values
+    overwritten while blocked, are not recorded. Other Variables pay nothing.
+
+    Values are pickled, so only replay logs you trust.
+
+        >>> import io
+        >>> log=io.BytesIO()
+        >>> price,volume=Variable(10),Variable(0)
+        >>> with Recorder(log,{'price': price,'volume': volume},clock=lambda: 0.0):
+        ...     price.value=11
+        ...     with volume.updates_coalesced():
+        ...         volume.value=5
+        ...         volume.value=7
+
+        Replay into a new graph
+        >>> class Turnover(Algorithm):
+        ...     _inputs_=('price','volume')
+        ...     _outputs_=('c',)
+        ...     def update(self):
+        ...         self.c.value=self.price.value*self.volume.value
+        >>> t=Turnover(price=0,volume=0)
+        >>> t.c.observe(pp("turnover"))
+        >>> t.volume.blocked.observe(pp("volume blocked"))
+        >>> replay(io.BytesIO(log.getvalue()),{'price': t.price,'volume': t.volume})
+        volume blocked: True
+        turnover: 77
+        volume blocked: False
+        6
+    """
+    def __init__(self,stream,variables,clock=time.time):
+        self.stream=stream
+        self.variables=dict(variables)
+        self.clock=clock
+        self._callbacks=[]
+
+    def start(self):
+        if self._callbacks:
+            return
+        stream=self.stream
+        if stream.tell() == 0:
+            stream.write(_LOG_MAGIC)
+        for index,(name,variable) in enumerate(sorted(self.variables.items())):
+            self._write(_LOG_DEFINE,index,name.encode('utf-8'))
+            self._on_value(index,variable.value)
+            if variable.is_blocked():
+                self._write(_LOG_BLOCK,index,b"")
+            on_value=functools.partial(self._on_value,index)
+            on_blocked=functools.partial(self._on_blocked,index)
+            variable.observe(on_value)
+            variable.blocked.observe(on_blocked)
+            self._callbacks.append((variable,on_value,on_blocked))
+
+    def stop(self):
+        for variable,on_value,on_blocked in self._callbacks:
+            variable.unobserve(on_value)
+            variable.blocked.unobserve(on_blocked)
+        self._callbacks=[]
+        self.stream.flush()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self,*exc):
+        self.stop()
+
+    def _write(self,kind,index,payload):
+        self.stream.write(_LOG_RECORD.pack(kind,index,self.clock(),len(payload))+payload)
+
+    def _on_value(self,index,value):
+        self._write(_LOG_VALUE,index,pickle.dumps(value,pickle.HIGHEST_PROTOCOL))
+
+    def _on_blocked(self,index,blocked):
+        self._write(_LOG_BLOCK if blocked else _LOG_UNBLOCK,index,b"")
+
+def _read_log(stream):
+    # Yield (kind, index, time, payload) for each record
+    if stream.read(len(_LOG_MAGIC)) != _LOG_MAGIC:
+        raise ValueError("Not an observer change log")
+    size=_LOG_RECORD.size
+    while True:
+        header=stream.read(size)
+        if len(header) < size:
+            return
+        kind,index,when,length=_LOG_RECORD.unpack(header)
+        yield kind,index,when,stream.read(length)
+
+def replay(stream,variables,batch=1000,until=None):
+    """
+    Apply a log written by a Recorder to the Variables named in variables,
+    ignoring any it doesn't name. Runs of up to `batch` value changes are
+    applied in one transaction, so intermediate values within a run are
+    skipped. Blocks and unblocks are applied between runs. With `until`, stops
+    at the first record logged after that time. Returns the number of records applied.
+    """
+    targets={}
+    changes=[]
+    applied=0
+    for kind,index,when,payload in _read_log(stream):
+        if until is not None and when > until:
+            break
+        if kind == _LOG_DEFINE:
+            targets[index]=variables.get(payload.decode('utf-8'))
+            continue
+        variable=targets.get(index)
+        if variable is None:
+            continue
+        applied+=1
+        if kind == _LOG_VALUE:
+            changes.append((variable,pickle.loads(payload)))
+            if len(changes) < batch:
+                continue
+        _apply_changes(changes)
+        if kind == _LOG_BLOCK:
+            variable.block()
+        elif kind == _LOG_UNBLOCK:
+            variable.unblock()
+    _apply_changes(changes)
+    return applied
+
+def feed(records,outputs=(),batch=1000,window=None,clock=time.time):
+    """
+    Feed records into source Variables in batches, yielding the values of
+    outputs after each one. A record is a (variable,value) pair, or a dict of
+    values by Variable to set together. A batch ends after `batch` records
+    or, with window, once a record arrives `window` seconds (by clock) after
+    the batch started. Each batch is applied in one transaction, so
+    downstream updates run once per batch and intermediate values are
+    skipped, as with updates_coalesced().
+
+        >>> a,b=Variable(0),Variable(0)
+        >>> total=a+b
+        >>> total.observe(pp("total"))
+        >>> records=[(a,1),(b,2),(a,3),{a: 5,b: 5},(b,1)]
+        >>> for values in feed(records,outputs=[total],batch=2):
+        ...     print values
+        total: 3
+        (3,)
+        total: 10
+        (10,)
+        total: 6
+        (6,)
+
+        With a window, batches end by time instead
+        >>> ticks=iter([0,1,2,3,4]).next
+        >>> list(feed(((a,i) for i in range(5)),outputs=[a],batch=100,window=2,clock=ticks))
+        total: 3
+        total: 5
+        [(2,), (4,)]
+
+    Column-wise data can be fed as rows, e.g. with
+    itertools.imap(dict,...) over zipped columns. Windows are only checked
+    as records arrive, so a quiet source holds back its last batch until
+    the next record or the end.
+    """
+    changes=[]
+    count=0
+    started=None
+    for record in records:
+        if isinstance(record,dict):
+            changes.extend(record.items())
+        else:
+            changes.append(record)
+        count+=1
+        if window is not None:
+            now=clock()
+            if started is None:
+                started=now
+            elif now-started >= window:
+                count=batch
+        if count >= batch:
+            _apply_changes(changes)
+            count=0
+            started=None
+            yield tuple(v.value for v in outputs)
+    if changes:
+        _apply_changes(changes)
+        yield tuple(v.value for v in outputs)
+
+def _apply_changes(changes):
+    if changes:
+        with transaction():
+            for variable,value in changes:
+                variable.set(value)
+        del changes[:]
+
+#Snapshot file: magic line, structure hash, entry count, then an entry per node and the payloads
+_SNAPSHOT_MAGIC=b"observer snapshot 1\n"
+_SNAPSHOT_HEADER=struct.Struct('<20sI')
+_SNAPSHOT_ENTRY=struct.Struct('<BQIQ')   # kind, offset, metadata length, data length
+_SNAPSHOT_PICKLE,_SNAPSHOT_ARRAY,_SNAPSHOT_ALGORITHM=range(3)
+
+def _graph_nodes(roots):
+    """
+    The Variables and Algorithms downstream of roots, with every Algorithm's
+    inputs and outputs, in a deterministic order. Returns the nodes and a hash
+    of the wiring between them.
+    """
+    order=[]
+    index={}
+    queue=collections.deque()
+    def visit(node):
+        if node not in index:
+            index[node]=len(order)
+            order.append(node)
+            queue.append(node)
+    for root in roots:
+        visit(root)
+    while queue:
+        node=queue.popleft()
+        if isinstance(node,Algorithm):
+            for variable in node.inputs+node.outputs:
+                visit(variable)
+        else:
+            for callback in node.observers:
+                target=_callback_target(callback)[0]
+                if isinstance(target,(Algorithm,Variable)):
+                    visit(target)
+    description=[]
+    for node in order:
+        if isinstance(node,Algorithm):
+            links=node.inputs+node.outputs
+        else:
+            links=[t for t in (_callback_target(c)[0] for c in node.observers) if t in index]
+        description.append("%s %s"%(type(node).__name__,' '.join(str(index[n]) for n in links)))
+    return order,hashlib.sha1('\n'.join(description).encode('utf-8')).digest()
+
+def snapshot(roots,path):
+    """
+    Save the values of every Variable in the graph downstream of roots, and
+    which lazy Algorithms have updates pending, to the file at path.
+    numpy arrays are stored raw, so restore() can map them from the file
+    without copying. Returns the number of nodes saved.
+    """
+    nodes,structure=_graph_nodes(roots)
+    entries=[]
+    for node in nodes:
+        if isinstance(node,Algorithm):
+            entries.append((_SNAPSHOT_ALGORITHM,b"",b"\x01" if node.updatePending else b"\x00"))
+            continue
+        value=node._value
+        if numpy is not None and type(value) is numpy.ndarray and not value.dtype.hasobject:
+            meta=pickle.dumps((value.dtype.str,value.shape),pickle.HIGHEST_PROTOCOL)
+            entries.append((_SNAPSHOT_ARRAY,meta,numpy.ascontiguousarray(value).tobytes()))
+        else:
+            entries.append((_SNAPSHOT_PICKLE,b"",pickle.dumps(value,pickle.HIGHEST_PROTOCOL)))
 
-        self.updatePending=False
-        self.outputs_blocked=Observable(False)
-        
-        self.enabled=Observable(enabled)
-        self.enabled.observe(self.check_blocks_and_update)
-        
-        assert isinstance(self._inputs_,(tuple,list))
-        for attrName,constructor in _get_variable_constructors(self._inputs_):
-            if hasattr(self,attrName):
-                inputVariable=getattr(self,attrName,None)
-            elif attrName in kwargs: 
-                inputVariable=constructor(kwargs[attrName])
+    offset=len(_SNAPSHOT_MAGIC)+_SNAPSHOT_HEADER.size+_SNAPSHOT_ENTRY.size*len(entries)
+    table=[]
+    payloads=[]
+    for kind,meta,data in entries:
+        padding=-(offset+len(meta))%16 if kind == _SNAPSHOT_ARRAY else 0  # align array data
+        table.append(_SNAPSHOT_ENTRY.pack(kind,offset,len(meta)+padding,len(data)))
+        payloads.extend((meta,b"\0"*padding,data))
+        offset+=len(meta)+padding+len(data)
+
+    temporary=path+'.tmp'
+    with open(temporary,'wb') as f:
+        f.write(_SNAPSHOT_MAGIC)
+        f.write(_SNAPSHOT_HEADER.pack(structure,len(entries)))
+        f.writelines(table)
+        f.writelines(payloads)
+    os.rename(temporary,path)
+    return len(nodes)
+
+def restore(roots,path):
+    """
+    Load a snapshot() of the same graph, built afresh, without running any
+    updates or notifying observers. The file is memory mapped, and numpy
+    arrays are read-only views of it. Raises ValueError if the graph is wired
+    differently. Returns the number of nodes restored.
+    """
+    nodes,structure=_graph_nodes(roots)
+    with open(path,'rb') as f:
+        size=os.fstat(f.fileno()).st_size
+        data=mmap.mmap(f.fileno(),size,access=mmap.ACCESS_READ) if size else b""
+    start=len(_SNAPSHOT_MAGIC)
+    if data[:start] != _SNAPSHOT_MAGIC:
+        raise ValueError("%s is not an observer snapshot"%path)
+    saved,count=_SNAPSHOT_HEADER.unpack_from(data,start)
+    if saved != structure or count != len(nodes):
+        raise ValueError("%s is a snapshot of a different graph"%path)
+    start+=_SNAPSHOT_HEADER.size
+    mapped=False
+    for n,node in enumerate(nodes):
+        kind,offset,meta,length=_SNAPSHOT_ENTRY.unpack_from(data,start+n*_SNAPSHOT_ENTRY.size)
+        if kind == _SNAPSHOT_ALGORITHM:
+            node.updatePending=data[offset:offset+length] == b"\x01"
+        elif kind == _SNAPSHOT_ARRAY:
+            dtype,shape=pickle.loads(data[offset:offset+meta])
+            dtype=numpy.dtype(dtype)
+            if length:
+                node._value=numpy.frombuffer(data,dtype,length//dtype.itemsize,offset+meta).reshape(shape)
+                mapped=True
             else:
-                inputVariable=constructor()
+                node._value=numpy.empty(shape,dtype)
+        else:
+            node._value=pickle.loads(data[offset+meta:offset+meta+length])
+    for node in nodes:
+        if isinstance(node,Algorithm):
+            node._restored()
+        elif isinstance(node,VariableArray):
+            node._synced=None  # its source's changed indices don't apply to restored values
+    if not mapped and size:
+        data.close()  # otherwise the arrays keep it open
+    return len(nodes)
 
-            setattr(self,attrName,inputVariable)
-            
-            inputVariable.blocked.observe(self.check_blocks_and_update)
-            inputVariable.observe(self.check_blocks_and_update)
+class ProxySender(object):
+    """
+    Sends the changes of some named Variables over a connection (such as one
+    end of a multiprocessing.Pipe) to a ProxyReceiver, which applies them to
+    Variables of the same names in another process. The changes made during
+    a wave are sent together once it has finished. Blocks and unblocks are
+    sent too, in order, so the other side coalesces updates the same way.
+    Starts with the current values and blocked flags.
+    """
+    def __init__(self,connection,variables):
+        self.connection=connection
+        self._batch=[]
+        self._callbacks=[]
+        names=sorted(variables)
+        connection.send(('names',names))
+        with propagator.wave():
+            for index,name in enumerate(names):
+                variable=variables[name]
+                self._queue(index,_LOG_VALUE,variable.value)
+                if variable.is_blocked():
+                    self._queue(index,_LOG_BLOCK,None)
+                on_value=functools.partial(self._queue,index,_LOG_VALUE)
+                on_blocked=functools.partial(self._on_blocked,index)
+                variable.observe(on_value)
+                variable.blocked.observe(on_blocked)
+                self._callbacks.append((variable,on_value,on_blocked))
+
+    def _queue(self,index,kind,value):
+        self._batch.append((index,kind,value))
+        if len(self._batch) == 1:
+            propagator.after_wave(self.flush)
+
+    def _on_blocked(self,index,blocked):
+        self._queue(index,_LOG_BLOCK if blocked else _LOG_UNBLOCK,None)
+
+    def flush(self):
+        batch,self._batch=self._batch,[]
+        if batch:
+            self.connection.send(('changes',batch))
+
+    def close(self):
+        for variable,on_value,on_blocked in self._callbacks:
+            variable.unobserve(on_value)
+            variable.blocked.unobserve(on_blocked)
+        self._callbacks=[]
 
-        assert isinstance(self._outputs_,(tuple,list))
-        for attrName,constructor in _get_variable_constructors(self._outputs_):  
-            if hasattr(self,attrName):
-                outputVariable=getattr(self,attrName,None)
-            elif attrName in kwargs: 
-                outputVariable=constructor(kwargs[attrName])
+class ProxyReceiver(object):
+    """
+    Applies the changes sent by a ProxySender to the Variables in variables
+    with the same names, ignoring the rest. The changes in a batch are
+    applied in transactions between blocks and unblocks, so downstream
+    Algorithms run once per batch.
+
+    Either call serve() to handle messages until the connection closes,
+    poll() to handle the ones that have arrived, or start() a thread that
+    hands them to propagator.submit. With a thread, every other change to
+    the graph has to go through submit too.
+    """
+    def __init__(self,connection,variables):
+        self.connection=connection
+        self.variables=dict(variables)
+        self._targets=[]
+        self.synced=None  # the last sync token the other side has answered
+
+    def serve(self):
+        while self._handle(self._apply):
+            pass
+
+    def poll(self,timeout=0):
+        """
+        Apply the changes that have arrived, waiting up to timeout seconds
+        for the first. Returns False once the connection is closed
+        """
+        while self.connection.poll(timeout):
+            if not self._handle(self._apply):
+                return False
+            timeout=0
+        return True
+
+    def start(self):
+        thread=threading.Thread(target=self._run)
+        thread.daemon=True
+        thread.start()
+        return thread
+
+    def _run(self):
+        apply=functools.partial(propagator.submit,self._apply)
+        while self._handle(apply):
+            pass
+
+    def _handle(self,apply):
+        # Handle one message. Returns False once the connection is closed
+        try:
+            message=self.connection.recv()
+        except EOFError:
+            return False
+        if message is None:
+            return False
+        kind,payload=message
+        if kind == 'names':
+            self._targets=[self.variables.get(name) for name in payload]
+        elif kind == 'changes':
+            apply(payload)
+        elif kind == 'sync':
+            self.connection.send(('synced',payload))
+        elif kind == 'synced':
+            self.synced=payload
+        return True
+
+    def _apply(self,batch):
+        changes=[]
+        for index,kind,value in batch:
+            variable=self._targets[index]
+            if variable is None:
+                continue
+            if kind == _LOG_VALUE:
+                changes.append((variable,value))
+                continue
+            _apply_changes(changes)
+            if kind == _LOG_BLOCK:
+                variable.block()
             else:
-                outputVariable=constructor()
-            setattr(self,attrName,outputVariable)
-            
-            self.outputs_blocked.observe(outputVariable.setBlocked)
+                variable.unblock()
+        _apply_changes(changes)
 
-        self.inputs=[getattr(self,n) for n,t in _get_variable_constructors(self._inputs_) ]
-        self.outputs=[getattr(self,n) for n,t in _get_variable_constructors(self._outputs_) ]
-            
-        self.check_blocks_and_update()
-   
-    def update(self):
-        pass
-    
-    def check_blocks_and_update(self,dummy=None):
-        isBlocked= not(self.enabled.value) or any(map(lambda i: i.blocked.value, self.inputs))      
-        if not isBlocked:
-            self.update()
+def _serve_partition(build,connection,inputs,outputs):
+    # Worker process for a Partition
+    graph=build()
+    receiver=ProxyReceiver(connection,dict((name,graph[name]) for name in inputs))
+    ProxySender(connection,dict((name,graph[name]) for name in outputs))
+    receiver.serve()
+    connection.close()
 
-        self.outputs_blocked.value = isBlocked
-        
+class Partition(object):
+    """
+    Part of a graph running in a worker process.
 
-    def observe(self,attribute,callback):
-        getattr(self,'_' + attribute).observe(callback)
-        
-    def unobserve(self,attribute,callback):
-        getattr(self,'_' + attribute).unobserve(callback)
-        
-    def get(varname,self):
-        variable=getattr(self,varname)
-        return variable.value
-    
-    def set(varname,self,value):
-        variable=getattr(self,varname)
-        variable.value=value
+    build() runs in the worker and returns a dict of its Variables by name.
+    The local Variables in inputs are tracked by the worker's Variables of
+    the same names, and `outputs` holds a local Variable tracking each of the
+    named worker Variables. Values and blocked flags cross the pipe in batches,
+    one per wave. Values must pickle.
+
+    Changes from the worker are applied on the calling thread, by sync() or
+    poll(), so they never race with local changes. sync() waits until
+    everything sent so far has made the round trip. A worker that sends a
+    lot between syncs fills the pipe and stalls until it's read, so poll()
+    regularly.
+
+        >>> class Square(Algorithm):
+        ...     _inputs_=('x',)
+        ...     _outputs_=('y',)
+        ...     def update(self):
+        ...         self.y.value=self.x.value**2
+        >>> def build():
+        ...     square=Square(x=0)
+        ...     return {'x': square.x,'y': square.y}
+        >>> x=Variable(3)
+        >>> worker=Partition(build,inputs={'x': x},outputs=['y'])
+        >>> y=worker.outputs['y']
+        >>> worker.sync()
+        >>> y.value
+        9
+        >>> y.observe(pp("y"))
+        >>> y.blocked.observe(pp("y blocked"))
+        >>> with x.updates_coalesced():
+        ...     x.value=4
+        ...     x.value=5
+        ...     worker.sync()
+        y blocked: True
+        >>> worker.sync()
+        y: 25
+        y blocked: False
+
+        Without sync(), changes wait until poll() picks them up
+        >>> x.value=6
+        >>> y.value
+        25
+        >>> while y.value == 25:
+        ...     worker.poll(1)
+        y: 36
+        >>> worker.close()
+    """
+    def __init__(self,build,inputs,outputs):
+        self.connection,child=multiprocessing.Pipe()
+        self.process=multiprocessing.Process(target=_serve_partition,args=(build,child,sorted(inputs),list(outputs)))
+        self.process.daemon=True
+        self.process.start()
+        child.close()
+        self.outputs=dict((name,Variable()) for name in outputs)
+        self._receiver=ProxyReceiver(self.connection,self.outputs)
+        self._sender=ProxySender(self.connection,inputs)
+        self._syncs=itertools.count()
+
+    def poll(self,timeout=0):
+        """
+        Apply the worker's changes that have arrived, waiting up to timeout
+        seconds for the first
+        """
+        self._sender.flush()
+        self._receiver.poll(timeout)
+
+    def sync(self):
+        """
+        Wait until the worker has handled everything sent so far, and apply its changes here
+        """
+        self._sender.flush()
+        token=next(self._syncs)
+        self.connection.send(('sync',token))
+        receiver=self._receiver
+        while receiver.synced != token:
+            if not receiver._handle(receiver._apply):
+                raise EOFError("The worker process has exited")
+
+    def close(self):
+        """
+        Stop the worker, applying whatever it sent before it stopped
+        """
+        self._sender.close()
+        self.connection.send(None)
+        receiver=self._receiver
+        while receiver._handle(receiver._apply):
+            pass
+        self.process.join()
+        self.connection.close()
 
 def pp(name):
     def p(x):
@@ -662,8 +4082,8 @@ def debugVariable(v,name):
     def blockWatch(b):
         assert(v.equality_test(v.value,v.pendingValue)) # Someone tried to manipulate blocked flag directly
         print (('-') * _nest_level) + name + " blocked: " + repr(b) + (" value: [%r]"%(v.value,))
-    v.observers.insert(0,pp(name + " value"))
-    v.blocked.observers.insert(0,blockWatch)
+    v._prepend_observer(pp(name + " value"))
+    v.blocked._prepend_observer(blockWatch)
     
 
 
@@ -713,12 +4133,264 @@ class Divide(Algorithm):
         else:
             self.c.value=self.a.value / self.b.value
 
+class Expression(Algorithm):
+    """
+    Evaluates a whole tree of arithmetic operators in one update().
+    This is what Variable operators build: applying an operator to the output
+    of an Expression copies its tree into a new Expression, so a formula ends up
+    as one Algorithm with one input per distinct Variable, whatever its size.
+    Only temporaries are copied: outputs that nothing else refers to, observes
+    or blocks. An output the caller has kept, e.g. in a variable, is read as
+    an input, so the bigger formula follows it if it is set, blocked or made
+    to track something. Accumulate long formulas with sum() or reduce(), which
+    keep no reference to the partial results, rather than total=total+v.
+
+    The tree is made of ('var',variable), ('const',value) and (op,left,right)
+    nodes, where op is one of '+', '-', '*', '/'. It is compiled to a single
+    function of straight-line code, one temporary per node, with constants
+    bound into it. Subtrees that are all constants are evaluated up front. As
+    with Add etc, the result is None if any input is None.
+
+    Expressions are lazy (see Algorithm): an intermediate result that is only
+    used to build a bigger formula is never evaluated.
+
+        >>> v1=Variable(3)
+        >>> v2=Variable(2)
+        >>> v3=(v1+3)/5*v2-v1
+        >>> v3.value
+        -1
+        >>> e=v3._producer
+        >>> e.source, len(e.inputs)
+        ('((((a0 + k0) / k1) * a1) - a0)', 2)
+        >>> v1.value=12
+        >>> v3.value
+        -6
+        >>> v2.value=None
+        >>> print v3.value
+        None
+
+        Constant subtrees are folded
+        >>> Expression(('*',('var',v1),('+',('const',2),('const',3)))).source
+        '(a0 * k0)'
+
+        v4 is kept by name, so v5 reads it
+        >>> v4=v1+1
+        >>> v5=v4*10
+        >>> v5._producer.source
+        '(a0 * k0)'
+        >>> w=Variable()
+        >>> linkVariables(v4,w)
+        >>> w.value=7
+        >>> v5.value
+        70
+
+        sum() leaves nothing to read
+        >>> sum([v1,v2,v4],Variable(0))._producer.source
+        '(((a0 + a1) + a2) + a3)'
+
+        v6 is observed, so v7 reads it
+        >>> v6=v1+1
+        >>> v6.observe(pp("v6"))
+        >>> v7=v6*10
+        >>> v7._producer.source
+        '(a0 * k0)'
+        >>> v7.value
+        130
+        >>> with v6.updates_coalesced():
+        ...     v6.value=1
+        ...     v7.value
+        130
+        v6: 1
+        >>> v7.value
+        10
+    """
+    _outputs_=('c',)
+    _lazy_=True
+
+    def __init__(self,tree,leaves=None):
+        """
+        leaves, if given, are the distinct Variables in tree in order of first
+        appearance, and tree is already folded
+        """
+        if leaves is None:
+            tree=_fold_constants(tree)
+            leaves=[node[1] for node in _tree_nodes(tree) if node[0] == 'var']
+            leaves=[v for n,v in enumerate(leaves) if not any(v is w for w in leaves[:n])]
+        self.tree=tree
+        self._code=None       # (lines,constants,result), generated on first use:
+        self._evaluate=None   # intermediate results usually never are
+        self._operands=leaves  # keep upstream Variables alive
+        self._inputs_=tuple('a%d'%i for i in range(len(leaves)))
+        Algorithm.__init__(self)
+        for leaf,algorithm_input in zip(leaves,self.inputs):
+            algorithm_input.track_variable(leaf,weak=True)
+
+    def _generate(self):
+        if self._code is None:
+            self._code=_expression_code(self.tree,self._operands)
+        return self._code
+
+    @property
+    def source(self):
+        """
+        The formula as one nested Python expression
+        """
+        lines,constants,result=self._generate()
+        text={}
+        for line in lines:
+            name,formula=line.split('=',1)
+            left,op,right=formula.split(' ')
+            text[name]='(%s %s %s)'%(text.get(left,left),op,text.get(right,right))
+        return text.get(result,result)
+
+    def update(self):
+        if any_var_is_none(self.inputs):
+            value=None
+        else:
+            if self._evaluate is None:
+                lines,constants,result=self._generate()
+                self._evaluate=_expression_function(lines,result,len(self.inputs),len(constants))(constants)
+            value=self._evaluate([i.value for i in self.inputs])
+        self.c.value=value
+
+_expression_operators={'+':operator.add,'-':operator.sub,'*':operator.mul,'/':operator.div}
+
+#Compiled expression factories, by source and arity. They take the constants and return the evaluator
+_expression_factories={}
+
+def _tree_nodes(tree):
+    """
+    The distinct nodes of tree, each after its operands, left to right.
+    Iterative, so deep trees don't hit the recursion limit
+    """
+    nodes=[]
+    done=set()
+    stack=[tree]
+    while stack:
+        node=stack[-1]
+        if id(node) in done:
+            stack.pop()
+            continue
+        if node[0] not in ('var','const'):
+            operands=[o for o in node[2:0:-1] if id(o) not in done]
+            if operands:
+                stack.extend(operands)
+                continue
+        stack.pop()
+        done.add(id(node))
+        nodes.append(node)
+    return nodes
+
+def _fold_node(kind,left,right):
+    # Fold (kind,left,right) whose operands are already folded
+    if (left[0] == 'const' and left[1] is None) or (right[0] == 'const' and right[1] is None):
+        return ('const',None)
+    if left[0] == right[0] == 'const':
+        return ('const',_expression_operators[kind](left[1],right[1]))
+    return (kind,left,right)
+
+def _fold_constants(tree):
+    folded={}
+    for node in _tree_nodes(tree):
+        if node[0] in ('var','const'):
+            folded[id(node)]=node
+        else:
+            left,right=folded[id(node[1])],folded[id(node[2])]
+            if left is node[1] and right is node[2] and 'const' not in (left[0],right[0]):
+                folded[id(node)]=node
+            else:
+                folded[id(node)]=_fold_node(node[0],left,right)
+    return folded[id(tree)]
+
+def _expression_code(tree,leaves):
+    """
+    Straight-line Python for tree, one assignment per operator node.
+    The Variables in leaves become arguments a0,a1..., constants k0,k1...
+    and operator results t0,t1...
+    returns (lines,constants,name of the result)
+    """
+    names={}
+    positions=dict((id(v),n) for n,v in enumerate(leaves))
+    constants=[]
+    lines=[]
+    for node in _tree_nodes(tree):
+        kind=node[0]
+        if kind == 'var':
+            name='a%d'%positions[id(node[1])]
+        elif kind == 'const':
+            name='k%d'%len(constants)
+            constants.append(node[1])
+        else:
+            name='t%d'%len(lines)
+            lines.append('%s=%s %s %s'%(name,names[id(node[1])],kind,names[id(node[2])]))
+        names[id(node)]=name
+    return lines,constants,names[id(tree)]
+
+def _expression_function(lines,result,nargs,nconstants):
+    # Arguments and constants are passed as sequences, so there is no limit on their number
+    key=('\n'.join(lines),result,nargs,nconstants)
+    factory=_expression_factories.get(key)
+    if factory is None:
+        source=['def factory(k):']
+        source.extend('    k%d=k[%d]'%(i,i) for i in range(nconstants))
+        source.append('    def evaluate(a):')
+        source.extend('        a%d=a[%d]'%(i,i) for i in range(nargs))
+        source.extend('        '+line for line in lines)
+        source.append('        return '+result)
+        source.append('    return evaluate')
+        namespace={}
+        exec '\n'.join(source) in namespace
+        factory=_expression_factories[key]=namespace['factory']
+    return factory
+
+#sys.getrefcount() in _fuse of an operand that is a temporary: an Expression result that
+#nothing but the formula being built refers to. Measured on first use, -1 while measuring
+_temporary_refs=None
+_measured_refs=[]
+
+def _temporary_refcount():
+    global _temporary_refs
+    _temporary_refs=-1
+    del _measured_refs[:]
+    (Variable(0)+0)*1
+    _temporary_refs=_measured_refs[0]
+    return _temporary_refs
+
+def _expression_node(x,refs):
+    # (tree,leaves) for an operand. The tree of a temporary Expression result is copied:
+    # anything the caller can still reach is read as an input, so it behaves as it always did
+    if isinstance(x,Variable):
+        if (isinstance(x._producer,Expression) and type(x) is Variable
+                and x._observers is None and not x.is_blocked()):
+            limit=_temporary_refs
+            if limit is None:
+                limit=_temporary_refcount()
+            elif limit < 0:
+                _measured_refs.append(refs)
+            if refs <= limit:
+                return x._producer.tree,x._producer._operands
+        return ('var',x),[x]
+    return ('const',x),[]
+
+def _fuse(op,left,right):
+    (left,leaves),(right,more)=_expression_node(left,sys.getrefcount(left)),_expression_node(right,sys.getrefcount(right))
+    if more:
+        seen=set(map(id,leaves))
+        leaves=leaves+[v for v in more if id(v) not in seen]
+    tree=_fold_node(op,left,right)  # operands are folded already
+    if tree[0] == 'const':
+        leaves=[]
+    return Expression(tree,leaves).c
+
 def variable_operation(algorithm,*inputs):
     """
 
     Doesn't handle IdentityVariable yet: That is, the inputs are not of the
     correct type, so identity_operation will throw on numpy arrays
 
+    The Algorithm tracks its inputs weakly, and lives as long as the returned
+    Variable does. Dropping the result lets the whole expression be collected.
+
     >>> v1=Variable(3)
     >>> v2=Variable(1)
 
@@ -738,16 +4410,569 @@ def variable_operation(algorithm,*inputs):
     >>> v1.value=0
     >>> v3.value
     -1
+
+    >>> import gc
+    >>> len(v1.observers)
+    1
+    >>> del v3
+    >>> _=gc.collect()
+    >>> v1.value=1
+    >>> len(v1.observers)
+    0
     """
     a=algorithm()
+    a._operands=inputs  # keep upstream expressions alive
     for input,algorithm_input in zip(inputs,a.inputs):
         if isinstance(input,Variable):
-            algorithm_input.track_variable(input)
+            algorithm_input.track_variable(input,weak=True)
         else:
             algorithm_input.value=input
 
     return a.outputs[0]
 
+def _changed_indices(old,new,candidates=None):
+    """
+    Flat indices of the elements that differ between arrays old and new.
+    Only candidates (flat indices) are compared if given. NaNs compare equal.
+    A change of shape or dtype changes every element.
+    """
+    if old is None or new is None or old.shape != new.shape or old.dtype != new.dtype:
+        return numpy.arange(0 if new is None else new.size)
+    if candidates is None:
+        old,new=old.ravel(),new.ravel()
+    else:
+        old,new=old.flat[candidates],new.flat[candidates]
+    differ=old != new
+    if new.dtype.kind in 'fc':
+        differ&=~(numpy.isnan(old) & numpy.isnan(new))
+    indices=numpy.flatnonzero(differ)
+    return indices if candidates is None else candidates[indices]
+
+class VariableArray(Variable):
+    """
+    A Variable whose value is a numpy array, treated as immutable: every change
+    produces a new array. Requires numpy.
+
+    Change detection is elementwise. After each notification, `changed` holds
+    the flat indices of the elements that changed, and `version` counts the
+    notifications, so observers can tell whether they missed any.
+
+    set_items() changes a slice or index set, only comparing the elements it
+    touches. A VariableArray tracking another one reuses its `changed` indices
+    instead of comparing the whole array again, as long as it still holds the
+    source's previous value.
+
+    Arithmetic operators build the vectorized ArrayAdd, ArraySubtract,
+    ArrayMultiply and ArrayDivide Algorithms, which only recompute the elements
+    whose inputs changed.
+    """
+    # _synced: the version of _source whose value this one holds, if it does
+    __slots__=('changed','version','_source','_synced')
+
+    def __init__(self,initialValue=None):
+        if numpy is None:
+            raise ImportError("VariableArray requires numpy")
+        Variable.__init__(self,None if initialValue is None else numpy.asarray(initialValue))
+        self.changed=numpy.arange(0)
+        self.version=0
+        self._source=None
+        self._synced=None
+
+    equality_test=lambda self,a,b: not len(_changed_indices(a,b))
+
+    def set(self,value,changed=None):
+        """
+        set value, or cache it if blocked.
+        changed: flat indices that differ from the current value, if known
+        """
+        if value is not None:
+            value=numpy.asarray(value)
+        if self.is_blocked() or _transaction_depth:
+            Variable.set(self,value)
+        else:
+            self._set(value,changed)
+
+    def _set(self,value,changed=None):
+        if changed is None:
+            changed=_changed_indices(self._value,value)
+        if len(changed) or (value is None) != (self._value is None):
+            self._value=value
+            self.changed=changed
+            self.version+=1
+            self._note_source()
+            self.notify_observers()
+
+    def _assign(self,value):
+        changed=_changed_indices(self._value,value)
+        if not len(changed) and (value is None) == (self._value is None):
+            return False
+        self._value=value
+        self.changed=changed
+        self.version+=1
+        self._note_source()
+        return True
+
+    def _note_source(self):
+        source=self._source
+        self._synced=source.version if source is not None and source._value is self._value else None
+
+    def set_items(self,index,values):
+        """
+        Equivalent to value[index]=values, without modifying the current array
+        """
+        current=self.get()
+        if current is None:
+            raise ValueError("Can't set items of %r, its value is None"%(self,))
+        new=current.copy()
+        new[index]=values
+        if self.is_blocked() or _transaction_depth:
+            self.set(new)
+        else:
+            candidates=numpy.arange(new.size).reshape(new.shape)[index].ravel()
+            self._set(new,_changed_indices(current,new,candidates))
+
+    def track_variable(self,sourceVar,weak=False):
+        if not isinstance(sourceVar,VariableArray):
+            return Variable.track_variable(self,sourceVar,weak)
+        self._source=sourceVar
+        self._synced=None
+        sourceVar.blocked.observe(self.setBlocked,weak)
+        sourceVar.observe(self._follow,weak)
+        self.set(sourceVar.value)
+        self._note_source()
+
+    def stop_tracking_variable(self,sourceVar):
+        if not isinstance(sourceVar,VariableArray):
+            return Variable.stop_tracking_variable(self,sourceVar)
+        sourceVar.blocked.unobserve(self.setBlocked)
+        sourceVar.unobserve(self._follow)
+        if self._source is sourceVar:
+            self._source=self._synced=None
+        if self.is_blocked():
+            self.blocked.value=False
+
+    def _follow(self,value):
+        # The source's changed indices are relative to our value if it is the source's previous one
+        source=self._source
+        if source is not None and value is source._value and self._synced == source.version-1:
+            self.set(value,source.changed)
+        else:
+            self.set(value)
+
+    def __add__(self,x):
+        return _array_operation(ArrayAdd,self,x)
+    def __sub__(self,x):
+        return _array_operation(ArraySubtract,self,x)
+    def __mul__(self,x):
+        return _array_operation(ArrayMultiply,self,x)
+    def __div__(self,x):
+        return _array_operation(ArrayDivide,self,x)
+
+    value = property(Variable.get,set)
+
+class _ArrayOperation(Algorithm):
+    """
+    Elementwise operation on VariableArrays: c = _operator_(a,b).
+    Only the elements at indices that changed in a or b since the last update
+    are recomputed, as long as shapes match (or b is a scalar array). Otherwise
+    the whole result is recomputed. The result is None if either input is None.
+    """
+    _inputs_=(('a',VariableArray),('b',VariableArray))
+    _outputs_=(('c',VariableArray),)
+
+    def __init__(self,enabled=None,**kwargs):
+        self._seen=None  # input versions at the last update
+        Algorithm.__init__(self,enabled,**kwargs)
+
+    def _restored(self):
+        Algorithm._restored(self)
+        self._seen=None  # the changed indices don't match the restored values
+
+    def _changed_since_update(self):
+        # Flat indices changed in either input since the last update, or None if unknown
+        seen=self._seen
+        if seen is None:
+            return None
+        changed=[]
+        for i,last in zip(self.inputs,seen):
+            if i.version == last+1:
+                changed.append(i.changed)
+            elif i.version != last:
+                return None
+        return numpy.union1d(*changed) if len(changed) == 2 else (changed[0] if changed else numpy.arange(0))
+
+    def update(self):
+        a,b,c=self.a.value,self.b.value,self.c.value
+        if a is None or b is None:
+            self._seen=None
+            self.c.value=None
+            return
+        changed=self._changed_since_update()
+        self._seen=[i.version for i in self.inputs]
+        if (changed is None or c is None or not (a.shape == c.shape and b.shape in (c.shape,()))
+                or numpy.result_type(a,b) != c.dtype):
+            self.c.value=self._operator_(a,b)
+        elif len(changed):
+            new=c.copy()
+            new.flat[changed]=self._operator_(a.flat[changed],b if b.ndim == 0 else b.flat[changed])
+            self.c.set(new,_changed_indices(c,new,changed))
+
+class ArrayAdd(_ArrayOperation):
+    _operator_=staticmethod(operator.add)
+
+class ArraySubtract(_ArrayOperation):
+    _operator_=staticmethod(operator.sub)
+
+class ArrayMultiply(_ArrayOperation):
+    _operator_=staticmethod(operator.mul)
+
+class ArrayDivide(_ArrayOperation):
+    _operator_=staticmethod(operator.div)
+
+def _array_operation(algorithm,*inputs):
+    # variable_operation for VariableArrays
+    a=algorithm()
+    a._operands=inputs
+    for input,algorithm_input in zip(inputs,a.inputs):
+        if isinstance(input,Variable):
+            algorithm_input.track_variable(input,weak=True)
+        else:
+            algorithm_input.value=input
+    return a.c
+
+if numpy is not None:
+    def __test_variable_array():
+        """
+            >>> a=VariableArray([1,2,3,4])
+            >>> a.observe(lambda value: pp("a changed at")(list(a.changed)))
+            >>> a.value=[1,2,5,4]
+            a changed at: [2]
+            >>> a.value=numpy.array([1,2,5,4])
+            >>> a.set_items(slice(0,2),[0,2])
+            a changed at: [0]
+
+            Blocked changes are compared once, on unblock
+            >>> with a.updates_coalesced():
+            ...     a.set_items(3,7)
+            ...     a.set_items(1,7)
+            ...     a.set_items(3,4)
+            a changed at: [1]
+
+            Vectorized operations only recompute what changed
+            >>> b=VariableArray([10,10,10,10])
+            >>> c=a+b
+            >>> c.value
+            array([10, 17, 15, 14])
+            >>> c.observe(lambda value: pp("c changed at")(list(c.changed)))
+            >>> b.set_items([0,3],[20,10])
+            c changed at: [0]
+            >>> c.value
+            array([20, 17, 15, 14])
+            >>> d=c*2
+            >>> a.set_items(2,0)
+            a changed at: [2]
+            c changed at: [2]
+            >>> d.value
+            array([40, 34, 20, 28])
+
+            Transactions coalesce arrays too: here c doesn't change at all
+            >>> with transaction():
+            ...     a.set_items(0,1)
+            ...     b.set_items(0,19)
+            a changed at: [0]
+            >>> c.value
+            array([20, 17, 10, 14])
+
+            Changing the type recomputes everything
+            >>> ints=VariableArray([1,2])
+            >>> ratio=ints/VariableArray([1,1])
+            >>> ratio._producer.b.value=numpy.array([2.0,1.0])
+            >>> ratio.value
+            array([0.5, 2. ])
+
+            So does setting equal values of another type
+            >>> halves=ints/VariableArray([2,2])
+            >>> halves.value
+            array([0, 1])
+            >>> ints.value=numpy.array([1.0,2.0])
+            >>> ints.value.dtype, list(ints.changed)
+            (dtype('float64'), [0, 1])
+            >>> halves.value
+            array([0.5, 1. ])
+
+            A tracking array that was set directly compares again
+            >>> source=VariableArray([0,0,0])
+            >>> copy=VariableArray()
+            >>> copy.track_variable(source)
+            >>> shifted=copy+VariableArray([1,1,1])
+            >>> copy.value=[9,9,9]
+            >>> source.set_items(0,1)
+            >>> copy.value, shifted.value
+            (array([1, 0, 0]), array([2, 1, 1]))
+
+            None propagates as usual
+            >>> a.value=None
+            a changed at: []
+            c changed at: []
+            >>> print c.value, d.value
+            None None
+            >>> a.set_items(0,1) # doctest: +ELLIPSIS
+            Traceback (most recent call last):
+            ...
+            ValueError: Can't set items of <...VariableArray object at ...>, its value is None
+        """
+
+    def __test_snapshot_arrays():
+        """
+        Restored arrays are read-only views of the snapshot file
+
+            >>> import os, tempfile
+            >>> def build():
+            ...     a=VariableArray(numpy.zeros(4))
+            ...     return a,a*2
+            >>> a,c=build()
+            >>> a.value=numpy.arange(4.0)
+            >>> path=os.path.join(tempfile.mkdtemp(),'arrays.snapshot')
+            >>> snapshot([a],path)
+            5
+            >>> a2,c2=build()
+            >>> restore([a2],path)
+            5
+            >>> c2.value, c2.value.flags.writeable
+            (array([0., 2., 4., 6.]), False)
+            >>> a2.set_items(1,5)
+            >>> c2.value
+            array([ 0., 10.,  4.,  6.])
+            >>> os.remove(path)
+        """
+
+def __test_snapshot():
+    """
+    Snapshots restore derived values without running updates
+
+        >>> import os, tempfile
+        >>> class Slow(Algorithm):
+        ...     _inputs_=('a','b')
+        ...     _outputs_=('c',)
+        ...     def update(self):
+        ...         if self.a.value:
+        ...             print "updating"
+        ...         self.c.value=self.a.value+self.b.value
+        >>> def build():
+        ...     x,y=Variable(0),Variable(0)
+        ...     first,second=Slow(a=0,b=0),Slow(a=0,b=1)
+        ...     first.a.track_variable(x)
+        ...     first.b.track_variable(y)
+        ...     second.a.track_variable(first.c)
+        ...     return x,y,first,second
+        >>> x,y,first,second=build()
+        >>> x.value=2
+        updating
+        updating
+        >>> path=os.path.join(tempfile.mkdtemp(),'graph.snapshot')
+        >>> snapshot([x,y],path)
+        10
+
+        >>> x2,y2,first2,second2=build()
+        >>> restore([x2,y2],path)
+        10
+        >>> x2.value, first2.c.value, second2.c.value
+        (2, 2, 3)
+        >>> y2.value=1
+        updating
+        updating
+        >>> second2.c.value
+        4
+
+        The structure has to match
+        >>> first2.c.observe(second2.b.set)
+        >>> restore([x2,y2],path)  # doctest: +ELLIPSIS
+        Traceback (most recent call last):
+            ...
+        ValueError: ... is a snapshot of a different graph
+        >>> os.remove(path)
+    """
+
+def __test_iterative():
+    """
+    Iterative propagation handles graphs deeper than the recursion limit
+
+        >>> propagator.iterative=True
+        >>> head=tail=Variable(0)
+        >>> for i in range(20000):
+        ...     v=Variable(0)
+        ...     v.track_variable(tail)
+        ...     tail=v
+        >>> tail.observe(pp("tail"))
+        >>> head.value=1
+        tail: 1
+
+        Blocking still travels down the chain ahead of the values
+        >>> tail.blocked.observe(pp("tail blocked"))
+        >>> with head.updates_coalesced():
+        ...     head.value=2
+        ...     head.value=3
+        tail blocked: True
+        tail: 3
+        tail blocked: False
+
+        Observers run in the same order as recursive propagation
+        >>> a,b=Variable(0),Variable(0)
+        >>> def relay(value):
+        ...     print "relay %r"%value
+        ...     b.value=value
+        >>> a.observe(relay)
+        >>> b.observe(pp("b"))
+        >>> a.observe(pp("a"))
+        >>> a.value=1
+        relay 1
+        b: 1
+        a: 1
+        >>> propagator.iterative=False
+    """
+
+def __test_create_many():
+    """
+    Slotted Algorithms, built in bulk
+
+        >>> class Scale(Algorithm):
+        ...     _inputs_=('x','factor')
+        ...     _outputs_=('y',)
+        ...     _slots_=True
+        ...     def update(self):
+        ...         self.y.value=self.x.value*self.factor.value
+        >>> sources=[Variable(n) for n in range(3)]
+        >>> scales=Scale.create_many(x=sources,factor=[10,20,30])
+        >>> [s.y.value for s in scales]
+        [0, 20, 60]
+        >>> sources[2].value=5
+        >>> scales[2].y.value
+        150
+        >>> hasattr(scales[0],'__dict__')
+        False
+        >>> Scale.create_many(x=sources,factor=[1])
+        Traceback (most recent call last):
+            ...
+        ValueError: Expected as many items for each port, got factor=1, x=3
+    """
+
+def __test_memoize():
+    """
+    Memoized Algorithms skip update() when they have seen the inputs before
+
+        >>> class Slow(Algorithm):
+        ...     _inputs_=('mode','scale')
+        ...     _outputs_=('result',)
+        ...     _memoize_=2
+        ...     def update(self):
+        ...         print "computing"
+        ...         self.result.value=len(self.mode.value)*self.scale.value
+        >>> s=Slow(mode="fast",scale=1)
+        computing
+        >>> s.result.observe(pp("result"))
+        >>> s.mode.value="slow"
+        computing
+        >>> s.mode.value="accurate"
+        computing
+        result: 8
+        >>> s.mode.value="slow"
+        result: 4
+
+        The cache holds two results, so "fast" has been evicted
+        >>> s.mode.value="fast"
+        computing
+        >>> s.memo_hits, s.memo_misses
+        (1, 4)
+
+        Use _memo_key_ to build keys from unhashable inputs. It gets the list of input values
+        >>> class Total(Algorithm):
+        ...     _inputs_=('items',)
+        ...     _outputs_=('total',)
+        ...     _memoize_=10
+        ...     _memo_key_=staticmethod(lambda values: tuple(values[0] or ()))
+        ...     def update(self):
+        ...         print "summing"
+        ...         self.total.value=sum(self.items.value or ())
+        >>> t=Total()
+        summing
+        >>> t.items.value=[1,2]
+        summing
+        >>> t.items.value=[]
+        >>> t.items.value=[1,2]
+        >>> t.total.value
+        3
+
+        Memoizing works with _slots_ too
+        >>> class Square(Algorithm):
+        ...     _inputs_=('x',)
+        ...     _outputs_=('y',)
+        ...     _memoize_=10
+        ...     _slots_=True
+        ...     def update(self):
+        ...         print "squaring"
+        ...         self.y.value=self.x.value**2
+        >>> q=Square(x=2)
+        squaring
+        >>> q.x.value=3
+        squaring
+        >>> q.x.value=2
+        >>> q.y.value, q.memo_hits, q.memo_misses, hasattr(q,'__dict__')
+        (4, 1, 2, False)
+    """
+
+def __test_threads():
+    """
+    Read-modify-write from several threads, serialized through the propagator
+
+        >>> counter=Variable(0)
+        >>> total=counter*2
+        >>> total.observe(lambda x: None)
+        >>> def increment():
+        ...     counter.value=counter.value+1
+        >>> def work():
+        ...     for i in range(500):
+        ...         propagator.submit(increment)
+        >>> threads=[threading.Thread(target=work) for i in range(4)]
+        >>> for thread in threads: thread.start()
+        >>> for thread in threads: thread.join()
+        >>> propagator.flush()
+        >>> counter.value, total.value
+        (2000, 4000)
+
+        Blocking works the same way
+        >>> propagator.submit(counter.block).result()
+        >>> propagator.submit(counter.set,7).result()
+        >>> counter.is_blocked(), total.value
+        (True, 4000)
+        >>> propagator.submit(counter.unblock).result()
+        >>> total.value
+        14
+
+        flush() waits for a batch another thread is still applying. Queued
+        behind it, a failing submission doesn't take the rest of its batch
+        down, and its error goes to whoever submitted it
+        >>> def slow_set(value):
+        ...     time.sleep(0.2)
+        ...     counter.value=value
+        >>> other=Variable(0)
+        >>> thread=threading.Thread(target=propagator.submit,args=(slow_set,3))
+        >>> thread.start(); time.sleep(0.05)
+        >>> failing=propagator.submit(operator.div,1,0)
+        >>> passing=propagator.submit(other.set,1)
+        >>> propagator.flush()
+        >>> counter.value, other.value
+        (3, 1)
+        >>> failing.result()
+        Traceback (most recent call last):
+        ...
+        ZeroDivisionError: integer division or modulo by zero
+        >>> thread.join()
+        >>> propagator.submit(operator.div,1,0)
+        Traceback (most recent call last):
+        ...
+        ZeroDivisionError: integer division or modulo by zero
+    """
+
 def __test_propagation():
     """
     Show that update coalescing actually works
@@ -769,6 +4994,30 @@ def __test_propagation():
     a1.c blocked: False
     a2.c value: 15
     a2.c blocked: False
+
+    A transaction coalesces the same batch without any blocked notifications
+    >>> with transaction():
+    ...     i1.value,i2.value,i3.value=(1,2,3)
+    ...
+    a1.c value: 3
+    a2.c value: 6
+
+    Notifications only hold the propagator while a scheduled Algorithm exists,
+    not for good once a transaction has scheduled something
+    >>> import gc
+    >>> _=gc.collect()
+    >>> propagator._holding
+    False
+    >>> class Scheduled(Algorithm):
+    ...     _inputs_=('a',)
+    ...     _scheduled_=True
+    >>> s=Scheduled(a=0)
+    >>> propagator._holding
+    True
+    >>> del s
+    >>> _=gc.collect()
+    >>> propagator._holding
+    False
     """
     pass
 
@@ -802,6 +5051,47 @@ def __test_algorithm():
 
     """
 
+def __test_lazy_algorithm():
+    """
+        >>> class Slow(Algorithm):
+        ...     _inputs_=('input',)
+        ...     _outputs_=('output',)
+        ...     _lazy_=True
+        ...     def update(self):
+        ...         print "computing %r"%(self.input.value,)
+        ...         self.output.value=self.input.value*10
+
+        Nothing is computed until the output is read
+        >>> s=Slow(input=1)
+        >>> s.input.value=2
+        >>> s.input.value=3
+        >>> s.updatePending
+        True
+        >>> s.output.value
+        computing 3
+        30
+        >>> s.output.value
+        30
+
+        Blocked inputs hold the pending update back, as usual
+        >>> s.input.block()
+        >>> s.input.value=4
+        >>> s.output.value
+        30
+        >>> s.input.unblock()
+        >>> s.output.value
+        computing 4
+        40
+
+        Observed outputs are kept up to date eagerly
+        >>> s.input.value=5
+        >>> s.output.observe(pp("output"))
+        computing 5
+        >>> s.input.value=6
+        computing 6
+        output: 60
+    """
+
 def __test_variable_operations():
     """
         >>> v1=Variable(0)
@@ -818,6 +5108,14 @@ def __test_variable_operations():
         >>> v3.value=5
         v4 value: 50
 
+        Long formulas fuse into one Expression without nesting its code
+        >>> v5=Variable(10)
+        >>> total=reduce(operator.add,[v5]+[1]*2000)
+        >>> total.value, len(total._producer.inputs)
+        (2010, 1)
+        >>> v5.value=0
+        >>> total.value
+        2000
     """
 def any_var_is_none(l):
     return any(map(lambda i: i.value is None,l))